@@ -0,0 +1,13 @@
+import asyncio
+import dotenv
+import os
+from jc.server.bus import Broker
+
+if __name__ == '__main__':
+  dotenv.load_dotenv(".env")
+  url = os.getenv('BROKER_URL', 'tcp://0.0.0.0:1235')
+
+  broker = Broker(url)
+  print(f'starting broker on {url}')
+  asyncio.get_event_loop().run_until_complete(broker.start())
+  asyncio.get_event_loop().run_forever()
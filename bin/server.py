@@ -3,20 +3,33 @@ import dotenv
 import os
 import ssl
 from jc import server
+from jc.server import cluster
+from jc.server.bus import create_bus
 
 if __name__ == '__main__':
   dotenv.load_dotenv(".env")
   host = os.getenv('SERVER_HOST')
   port = int(os.getenv('SERVER_PORT'))
+  workers = int(os.getenv('WORKERS', 1))
 
   crt_file = os.getenv('CRT_FILE')
   key_file = os.getenv('KEY_FILE')
+  if workers > 1:
+    cert_files = None if crt_file is None or key_file is None else (crt_file, key_file)
+    cluster.run_workers(workers, host, port, cert_files, os.getenv('BUS_URL'))
+    exit(0)
+
   if crt_file is None or key_file is None:
     ssl_ctx = None
   else:
     ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     ssl_ctx.load_cert_chain(certfile=crt_file, keyfile=key_file)
 
-  server = server.Server(host, port, ssl_ctx)
+  server = server.Server(host, port, ssl_ctx, bus=create_bus(os.getenv('BUS_URL')))
   asyncio.get_event_loop().run_until_complete(server.serve())
-  asyncio.get_event_loop().run_forever()
+  try:
+    asyncio.get_event_loop().run_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    asyncio.get_event_loop().run_until_complete(server.close())
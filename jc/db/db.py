@@ -3,19 +3,31 @@ import aiomysql
 import os
 
 from contextlib import asynccontextmanager
+from datetime import datetime
 from aiomysql.connection import Connection
 from aiomysql.cursors import Cursor
 from aiomysql.pool import Pool
 
+from jc.db import tables
 from jc.db.tables import TABLES
 
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
+
+# process-wide pool for the application database,
+# created by `init_pool` and closed by `close_pool`
+_pool: Optional[Pool] = None
+# set between `init_pool` and `close_pool`, if the pool couldn't be
+# created it's tried again by the next query after `POOL_RETRY_INTERVAL`
+_pool_wanted = False
+_pool_failed_at: Optional[float] = None
+_pool_lock: Optional[asyncio.Lock] = None
+POOL_RETRY_INTERVAL = 5.0
 
 def _get_db() -> str:
   env = os.getenv('ENV', 'development')
   return f'jc_{env}'
 
-async def _create_pool(db: str = None) -> Pool:
+async def _create_pool(db: str = None, **kwargs) -> Pool:
   host = os.getenv('MYSQL_HOST', 'localhost')
   port = int(os.getenv('MYSQL_PORT', 3306))
   user = os.getenv('MYSQL_USER')
@@ -25,11 +37,85 @@ async def _create_pool(db: str = None) -> Pool:
     port=port, 
     user=user,
     password=password,
-    db=db
+    db=db,
+    # reads don't leave a transaction open, a connection that is
+    # released in a transaction is closed instead of reused
+    autocommit=True,
+    **kwargs
   )
 
+async def init_pool():
+  global _pool, _pool_wanted, _pool_failed_at
+  _pool_wanted = True
+  if _pool is not None:
+    return
+
+  try:
+    _pool = await _create_pool(
+      _get_db(),
+      minsize=int(os.getenv('MYSQL_POOL_MIN', 1)),
+      maxsize=int(os.getenv('MYSQL_POOL_MAX', 10)),
+      # reopen connections before the server drops them (wait_timeout)
+      pool_recycle=int(os.getenv('MYSQL_POOL_RECYCLE', 3600))
+    )
+    _pool_failed_at = None
+  except Exception as e:
+    print('failed to create database pool')
+    print(e)
+    _pool_failed_at = asyncio.get_event_loop().time()
+
+# the pool, created again if it failed before and it's been a while
+async def _get_pool() -> Pool:
+  global _pool_lock
+  if _pool is None:
+    if _pool_lock is None:
+      _pool_lock = asyncio.Lock()
+    # concurrent queries wait for a single attempt
+    async with _pool_lock:
+      retry_at = (_pool_failed_at or 0) + POOL_RETRY_INTERVAL
+      if _pool is None and asyncio.get_event_loop().time() >= retry_at:
+        await init_pool()
+  if _pool is None:
+    raise ConnectionError('database pool is not available')
+  return _pool
+
+async def close_pool():
+  global _pool, _pool_wanted
+  _pool_wanted = False
+  if _pool is None:
+    return
+
+  pool = _pool
+  _pool = None
+  pool.close()
+  await pool.wait_closed()
+
+@asynccontextmanager
+async def _pooled_connection():
+  acquire_timeout = float(os.getenv('MYSQL_ACQUIRE_TIMEOUT', 5))
+  ping_interval = float(os.getenv('MYSQL_PING_INTERVAL', 30))
+
+  pool = await _get_pool()
+  conn: Connection = await asyncio.wait_for(pool.acquire(), acquire_timeout)
+  try:
+    # check connections that have been idle for a while
+    # so a dropped connection doesn't fail the query
+    if asyncio.get_event_loop().time() - conn.last_usage > ping_interval:
+      await conn.ping(reconnect=True)
+    curs: Cursor
+    async with conn.cursor() as curs:
+      yield conn, curs
+  finally:
+    pool.release(conn)
+
 @asynccontextmanager
 async def mysql_connection(db: str=None):
+  if _pool_wanted and db == _get_db():
+    async with _pooled_connection() as (conn, curs):
+      yield conn, curs
+    return
+
+  # one-off connection, i.e. before the database exists
   pool = await _create_pool(db)
   try:
     conn: Connection
@@ -41,6 +127,17 @@ async def mysql_connection(db: str=None):
     pool.close()
     await pool.wait_closed()
 
+# runs the statements of the block in a transaction
+@asynccontextmanager
+async def transaction(conn: Connection):
+  await conn.begin()
+  try:
+    yield
+  except BaseException:
+    await conn.rollback()
+    raise
+  await conn.commit()
+
 #
 
 async def create_tables():
@@ -51,14 +148,29 @@ async def create_tables():
       await curs.execute(f'USE {db};')
       for query in TABLES:
         await curs.execute(query)
+      await _migrate_emotes(curs)
   except:
     print('failed to setup database')  
 
+async def _migrate_emotes(curs: Cursor):
+  await curs.execute(tables.EMOTES_UNIQUE_KEY_EXISTS)
+  if (await curs.fetchone())[0] > 0:
+    return
+  print('adding the unique key to the emotes table')
+  await curs.execute(tables.EMOTES_DEDUPE)
+  try:
+    await curs.execute(tables.EMOTES_ADD_UNIQUE_KEY)
+  except Exception:
+    # another worker may have added it in the meantime
+    await curs.execute(tables.EMOTES_UNIQUE_KEY_EXISTS)
+    if (await curs.fetchone())[0] == 0:
+      raise
+
 async def get_emotes(org_id: str) -> List[Tuple[str, str]]:
   db = _get_db()
   try:
     async with mysql_connection(db) as (_, curs):
-      await curs.execute(f'SELECT name, url FROM emotes WHERE organization_id={org_id};')
+      await curs.execute('SELECT name, url FROM emotes WHERE organization_id=%s;', (org_id,))
       result = await curs.fetchall()
       return result
   except Exception as e:
@@ -66,29 +178,148 @@ async def get_emotes(org_id: str) -> List[Tuple[str, str]]:
     print(e)
     return []
 
-async def save_emotes(org_id: str, emotes: List[Tuple[str, str]]):
+async def get_emotes_bulk(org_ids: List[str]) -> Dict[str, List[Tuple[str, str]]]:
+  """
+  Loads the emotes of several organizations with a single query.
+  Every organization is in the result, with no emotes on failure.
+  """
+  db = _get_db()
+  result = {org_id: [] for org_id in org_ids}
+  # ids that aren't numbers have no emotes, the others are still loaded
+  keys: Dict[int, List[str]] = {}
+  for org_id in org_ids:
+    try:
+      keys.setdefault(int(org_id), []).append(org_id)
+    except ValueError:
+      print(f'invalid organization id {org_id}')
+  if len(keys) == 0:
+    return result
+  try:
+    async with mysql_connection(db) as (_, curs):
+      ids = ','.join(['%s'] * len(keys))
+      await curs.execute(
+        f'SELECT organization_id, name, url FROM emotes WHERE organization_id IN ({ids});',
+        tuple(keys))
+      for org_id, name, url in await curs.fetchall():
+        for key in keys[org_id]:
+          result[key] += [(name, url)]
+  except Exception as e:
+    print('failed to get emotes')
+    print(e)
+  return result
+
+async def save_emotes(org_id: str, emotes: List[Tuple[str, str]]) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]], List[str]]:
+  """
+  Replaces the emote set of an organization. Only the rows that differ
+  from the stored set are written. Returns the new set along with the
+  added (or changed) emotes and the names of the removed emotes.
+  """
   db = _get_db()
   org_id = int(org_id)
-  data = [(org_id, *pair) for pair in emotes]
+  new_emotes = dict(emotes)
   try:
-    async with mysql_connection(db) as (conn, curs):
-      stmt = "INSERT INTO emotes (organization_id, name, url) VALUES (%s,%s,%s)"
-      await curs.executemany(stmt, data)
-      await conn.commit()
+    async with mysql_connection(db) as (conn, curs), transaction(conn):
+      await curs.execute(
+        'SELECT name, url FROM emotes WHERE organization_id=%s FOR UPDATE;', (org_id,))
+      current = dict(await curs.fetchall())
 
-      await curs.execute(f'SELECT name, url FROM emotes WHERE organization_id={org_id};')
-      result = await curs.fetchall()
+      added = [(name, url) for name, url in new_emotes.items() if current.get(name) != url]
+      removed = [name for name in current if name not in new_emotes]
+      if len(added) > 0:
+        stmt = (
+          'INSERT INTO emotes (organization_id, name, url, created_at, updated_at) '
+          'VALUES (%s,%s,%s,NOW(),NOW()) '
+          'ON DUPLICATE KEY UPDATE url=VALUES(url), updated_at=NOW()'
+        )
+        await curs.executemany(stmt, [(org_id, name, url) for name, url in added])
+      if len(removed) > 0:
+        names = ','.join(['%s'] * len(removed))
+        await curs.execute(
+          f'DELETE FROM emotes WHERE organization_id=%s AND name IN ({names});',
+          (org_id, *removed))
+      return list(new_emotes.items()), added, removed
+  except Exception as e:
+    print('failed to save emotes')
+    raise e
+
+async def save_emotes_bulk(sets: Dict[str, List[Tuple[str, str]]]) -> Dict[str, Tuple[List[Tuple[str, str]], List[Tuple[str, str]], List[str]]]:
+  """
+  Replaces the emote sets of several organizations in one transaction
+  with the same statements as `save_emotes` regardless of the number
+  of organizations. Returns the result of `save_emotes` per organization.
+  """
+  db = _get_db()
+  new_sets = {org_id: dict(emotes) for org_id, emotes in sets.items()}
+  if len(new_sets) == 0:
+    return {}
+  try:
+    keys = {int(org_id): org_id for org_id in new_sets}
+    async with mysql_connection(db) as (conn, curs), transaction(conn):
+      ids = ','.join(['%s'] * len(keys))
+      await curs.execute(
+        f'SELECT organization_id, name, url FROM emotes WHERE organization_id IN ({ids}) FOR UPDATE;',
+        tuple(keys))
+      current = {org_id: {} for org_id in new_sets}
+      for org_id, name, url in await curs.fetchall():
+        current[keys[org_id]][name] = url
+
+      result = {}
+      inserts = []
+      deletes = []
+      for org_id, new_emotes in new_sets.items():
+        added = [(name, url) for name, url in new_emotes.items() if current[org_id].get(name) != url]
+        removed = [name for name in current[org_id] if name not in new_emotes]
+        inserts += [(int(org_id), name, url) for name, url in added]
+        deletes += [(int(org_id), name) for name in removed]
+        result[org_id] = (list(new_emotes.items()), added, removed)
+
+      if len(inserts) > 0:
+        stmt = (
+          'INSERT INTO emotes (organization_id, name, url, created_at, updated_at) '
+          'VALUES (%s,%s,%s,NOW(),NOW()) '
+          'ON DUPLICATE KEY UPDATE url=VALUES(url), updated_at=NOW()'
+        )
+        await curs.executemany(stmt, inserts)
+      if len(deletes) > 0:
+        rows = ','.join(['(%s,%s)'] * len(deletes))
+        await curs.execute(
+          f'DELETE FROM emotes WHERE (organization_id, name) IN ({rows});',
+          tuple(value for row in deletes for value in row))
       return result
   except Exception as e:
     print('failed to save emotes')
     raise e
 
+async def save_chat_messages(rows: List[Tuple[str, str, str, str, datetime]]):
+  """
+  Inserts (stream_id, type, user, text, created_at) rows
+  with a single multi-row insert.
+  """
+  db = _get_db()
+  async with mysql_connection(db) as (_, curs):
+    stmt = (
+      'INSERT INTO chat_messages (stream_id, type, user, text, created_at) '
+      'VALUES (%s,%s,%s,%s,%s)'
+    )
+    await curs.executemany(stmt, rows)
+
 async def delete_emotes(org_id: str):
   db = _get_db()
   try:
-    async with mysql_connection(db) as (conn, curs):
-      await curs.execute(f'DELETE FROM emotes WHERE organization_id={org_id};')
-      await conn.commit()
+    async with mysql_connection(db) as (_, curs):
+      await curs.execute('DELETE FROM emotes WHERE organization_id=%s;', (int(org_id),))
+  except Exception as e:
+    print('failed to delete emotes')
+    raise e
+
+async def delete_emotes_bulk(org_ids: List[str]):
+  db = _get_db()
+  if len(org_ids) == 0:
+    return
+  try:
+    async with mysql_connection(db) as (_, curs):
+      ids = ','.join(['%s'] * len(org_ids))
+      await curs.execute(f'DELETE FROM emotes WHERE organization_id IN ({ids});', tuple(org_ids))
   except Exception as e:
     print('failed to delete emotes')
     raise e
@@ -4,14 +4,50 @@ EMOTES_TABLE = '''
   CREATE TABLE IF NOT EXISTS `emotes` (
     `id` INT NOT NULL AUTO_INCREMENT,
     `organization_id` INT,
-    `name` VARCHAR(255),
+    `name` VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin,
     `url` VARCHAR(255),
     `created_at` DATETIME,
     `updated_at` DATETIME,
-    PRIMARY KEY (`id`)
+    PRIMARY KEY (`id`),
+    UNIQUE KEY `organization_name` (`organization_id`, `name`)
   );
 '''
 
+CHAT_MESSAGES_TABLE = '''
+  CREATE TABLE IF NOT EXISTS `chat_messages` (
+    `id` BIGINT NOT NULL AUTO_INCREMENT,
+    `stream_id` VARCHAR(255) NOT NULL,
+    `type` VARCHAR(16) NOT NULL,
+    `user` VARCHAR(255),
+    `text` TEXT,
+    `created_at` DATETIME(3) NOT NULL,
+    PRIMARY KEY (`id`),
+    KEY `stream_time` (`stream_id`, `created_at`)
+  );
+'''
+
+# emotes tables created before the unique key get it added, duplicate
+# names are removed first keeping the newest row
+EMOTES_UNIQUE_KEY_EXISTS = '''
+  SELECT COUNT(*) FROM information_schema.statistics
+  WHERE table_schema = DATABASE() AND table_name = 'emotes' AND index_name = 'organization_name';
+'''
+
+EMOTES_DEDUPE = '''
+  DELETE older FROM `emotes` older
+  JOIN `emotes` newer
+    ON older.organization_id = newer.organization_id
+    AND BINARY older.name = BINARY newer.name
+    AND older.id < newer.id;
+'''
+
+EMOTES_ADD_UNIQUE_KEY = '''
+  ALTER TABLE `emotes`
+    MODIFY `name` VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin,
+    ADD UNIQUE KEY `organization_name` (`organization_id`, `name`);
+'''
+
 TABLES = [
-  EMOTES_TABLE
+  EMOTES_TABLE,
+  CHAT_MESSAGES_TABLE
 ]
@@ -0,0 +1,152 @@
+# Pre-serialized messages that are shared by every recipient of a broadcast
+from __future__ import annotations
+
+import asyncio
+import zlib
+from websockets.frames import Frame
+
+from jc.server import message
+from jc.server.message import Codec
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+# smaller payloads are sent uncompressed even if compression was
+# negotiated, deflating them saves little or nothing
+COMPRESS_MIN_SIZE = 256
+COMPRESS_LEVEL = 6
+
+
+def deflate(data: bytes, window_bits: int) -> bytes:
+  """
+  Compresses a whole message for permessage-deflate without context
+  takeover, so the result is valid on every connection that negotiated
+  the same server window size.
+  """
+  compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -window_bits)
+  data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+  # the empty block at the end is left out (RFC 7692 7.2.1)
+  return data[:-4]
+
+
+class PreparedMessage:
+  """
+  A server message that is serialized at most once per codec and then
+  written to any number of connections. The payload and frame for a
+  codec are built lazily the first time a connection using it asks
+  for them and then reused as is.
+
+  Messages that list other messages (batches, history) are built out
+  of the payloads of those `parts` instead of encoding them again.
+  """
+  def __init__(self, obj: object, parts: List[PreparedMessage] = None):
+    self.obj = obj
+    self.parts = parts
+    # for delta messages, the full state to send instead
+    # when a client can't apply the delta
+    self.full: Optional[PreparedMessage] = None
+    self._payloads: Dict[Codec, bytes] = {}
+    self._frames: Dict[Tuple[Codec, Optional[int]], bytes] = {}
+    self._size: Optional[int] = None
+
+  @property
+  def type(self) -> str:
+    return self.obj['type']
+
+  # the json payload
+  @property
+  def data(self) -> bytes:
+    return self.payload(message.JSON)
+
+  def size(self) -> int:
+    """
+    Returns the size of a payload that was already built, or else an
+    estimate from the message itself, so that accounting for memory
+    doesn't encode the message with a codec nobody uses. The first
+    answer is kept so it stays the same for the life of the message.
+    """
+    if self._size is None:
+      payload = next(iter(self._payloads.values()), None)
+      self._size = len(payload) if payload is not None else _estimate_size(self.obj)
+    return self._size
+
+  def payload(self, codec: Codec) -> bytes:
+    data = self._payloads.get(codec)
+    if data is None:
+      if self.parts is not None:
+        data = codec.encode_list(self.type, [part.payload(codec) for part in self.parts])
+      else:
+        data = codec.encode(self.obj)
+      self._payloads[codec] = data
+    return data
+
+  # server -> client frames are never masked so the same
+  # bytes are valid for every connection
+  def frame(self, codec: Codec, deflate_bits: int = None) -> bytes:
+    """
+    Returns the frame for connections using `codec`, compressed with a
+    `deflate_bits` window if given. Each variant is built only once.
+    """
+    payload = self.payload(codec)
+    if len(payload) < COMPRESS_MIN_SIZE:
+      deflate_bits = None
+    key = (codec, deflate_bits)
+    frame = self._frames.get(key)
+    if frame is None:
+      if deflate_bits is None:
+        frame = Frame(True, codec.opcode, payload).serialize(mask=False)
+      else:
+        compressed = deflate(payload, deflate_bits)
+        # serialize rejects rsv1 without the extension, so it's set afterwards
+        frame = bytearray(Frame(True, codec.opcode, compressed).serialize(mask=False))
+        frame[0] |= 0x40
+        frame = bytes(frame)
+      self._frames[key] = frame
+    return frame
+
+
+def _estimate_size(obj: object) -> int:
+  if isinstance(obj, str):
+    return len(obj) + 2
+  if isinstance(obj, dict):
+    return sum(_estimate_size(key) + _estimate_size(value) + 2 for key, value in obj.items()) + 2
+  if isinstance(obj, list):
+    return sum(_estimate_size(value) + 1 for value in obj) + 2
+  return 8
+
+
+class Batcher:
+  """
+  Collects text messages over a short window and hands them over as
+  a single text_batch message. The window starts with the first message
+  so no message waits longer than `interval` seconds, and a full batch
+  is flushed right away.
+  """
+  MAX_SIZE = 100
+
+  def __init__(self, interval: float, flush: Callable[[List[PreparedMessage], PreparedMessage], None]):
+    self.interval = interval
+    self.flush_cb = flush
+    self.pending: List[PreparedMessage] = []
+    self.handle: Optional[asyncio.TimerHandle] = None
+
+  def add(self, msg: PreparedMessage):
+    self.pending += [msg]
+    if len(self.pending) >= self.MAX_SIZE:
+      self.flush()
+    elif self.handle is None:
+      self.handle = asyncio.get_event_loop().call_later(self.interval, self.flush)
+
+  def flush(self):
+    if self.handle is not None:
+      self.handle.cancel()
+      self.handle = None
+    if len(self.pending) == 0:
+      return
+
+    msgs = self.pending
+    self.pending = []
+    batch = PreparedMessage(message.text_batch_message([msg.obj for msg in msgs]), msgs)
+    self.flush_cb(msgs, batch)
+
+  def close(self):
+    self.flush()
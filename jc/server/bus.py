@@ -0,0 +1,291 @@
+# Message bus used to share stream events between server nodes
+# (worker processes or machines)
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import secrets
+import socket
+from urllib.parse import urlsplit
+
+from typing import Callable, Coroutine, Dict, List, Optional, Set
+
+
+def default_node_id() -> str:
+  return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class MessageBus:
+  """
+  Interface for the bus backends. Events are json-serializable dicts
+  which are delivered to every other node on the bus, but never back
+  to the node that sent them.
+
+  An event with a `retain` key is also kept by the bus (the newest
+  event per key) and delivered to nodes that connect later, so they
+  can catch up on org and stream state.
+  """
+  def __init__(self, node_id: str):
+    self.node_id = node_id
+
+  async def connect(self, handler: Callable[[dict], Coroutine]):
+    pass
+
+  async def close(self):
+    pass
+
+  def send(self, event: dict):
+    pass
+
+
+class LocalBus(MessageBus):
+  """
+  In-process backend. Nodes in the same process that share a channel
+  receive each other's events, with a single node it does nothing.
+  """
+  channels: Dict[str, List[LocalBus]] = {}
+
+  def __init__(self, node_id: str, channel: str = 'default'):
+    super().__init__(node_id)
+    self.channel = channel
+    self.handler: Optional[Callable[[dict], Coroutine]] = None
+
+  async def connect(self, handler: Callable[[dict], Coroutine]):
+    self.handler = handler
+    LocalBus.channels.setdefault(self.channel, []).append(self)
+
+  async def close(self):
+    LocalBus.channels[self.channel].remove(self)
+
+  def send(self, event: dict):
+    event['node'] = self.node_id
+    loop = asyncio.get_event_loop()
+    for bus in LocalBus.channels.get(self.channel, []):
+      if bus is not self:
+        loop.create_task(bus.handler(event))
+
+
+class BrokerBus(MessageBus):
+  """
+  Client for a `Broker` reachable over tcp or a unix socket. Every
+  event is a single network hop to the broker which relays it.
+
+  When the connection is lost the client reconnects with a backoff and
+  the broker replays the retained events to it. Retained events sent
+  while disconnected are sent after reconnecting, and all retained
+  events of this node are sent again if the broker was restarted and
+  lost them. Other events are dropped while disconnected or while
+  more than `MAX_BUFFER` bytes wait to be written to the broker.
+  """
+  RECONNECT_DELAY = 0.5
+  RECONNECT_MAX_DELAY = 10
+  MAX_BUFFER = 4 * 1024 * 1024
+
+  def __init__(self, node_id: str, url: str):
+    super().__init__(node_id)
+    self.url = url
+    self.writer: Optional[asyncio.StreamWriter] = None
+    self.handler: Callable[[dict], Coroutine]
+    self.task: asyncio.Task
+    # the last retained event this node sent per key
+    self.retained: Dict[str, bytes] = {}
+    self.unsent: Set[str] = set()
+    self.broker_id: Optional[str] = None
+    self.dropped = 0
+
+  async def connect(self, handler: Callable[[dict], Coroutine]):
+    self.handler = handler
+    reader, self.writer = await open_connection(self.url)
+    self._send_hello()
+    self.task = asyncio.get_event_loop().create_task(self._reader_task(reader))
+
+  async def close(self):
+    self.task.cancel()
+    try:
+      await self.task
+    except asyncio.CancelledError:
+      pass
+    if self.writer is not None:
+      self.writer.close()
+
+  def send(self, event: dict):
+    event['node'] = self.node_id
+    line = json.dumps(event).encode('utf-8') + b'\n'
+    connected = self.writer is not None and not self.writer.is_closing()
+    if 'retain' in event:
+      self.retained.pop(event['retain'], None)
+      self.retained[event['retain']] = line
+      if not connected:
+        self.unsent.add(event['retain'])
+        return
+    elif not connected or self.writer.transport.get_write_buffer_size() > self.MAX_BUFFER:
+      self.dropped += 1
+      return
+    self.writer.write(line)
+
+  async def _reader_task(self, reader: asyncio.StreamReader):
+    while True:
+      await self._read_events(reader)
+      print(f'[node {self.node_id}] bus connection lost, reconnecting')
+      self.writer.close()
+      self.writer = None
+      reader = await self._reconnect()
+
+  async def _read_events(self, reader: asyncio.StreamReader):
+    while True:
+      try:
+        line = await reader.readline()
+      except (ConnectionError, ValueError):
+        return
+      if not line:
+        return
+      try:
+        event = json.loads(line)
+        if event['op'] == 'hello':
+          self._on_hello(event['broker'])
+        else:
+          await self.handler(event)
+      except Exception as e:
+        print(f'[node {self.node_id}] failed to handle bus event')
+        print(e)
+
+  async def _reconnect(self) -> asyncio.StreamReader:
+    delay = self.RECONNECT_DELAY
+    while True:
+      try:
+        reader, self.writer = await open_connection(self.url)
+        self._send_hello()
+        return reader
+      except OSError:
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+
+  # tells the broker which node this is
+  def _send_hello(self):
+    self.writer.write(json.dumps({'op': 'hello', 'node': self.node_id}).encode('utf-8') + b'\n')
+
+  def _on_hello(self, broker_id: str):
+    if self.broker_id is None or broker_id == self.broker_id:
+      keys = [key for key in self.retained if key in self.unsent]
+    else:
+      # a new broker doesn't have the state of this node
+      keys = list(self.retained)
+    self.broker_id = broker_id
+    self.unsent.clear()
+    for key in keys:
+      self.writer.write(self.retained[key])
+
+
+class Broker:
+  """
+  Relays every event received from a node to all the other nodes and
+  keeps the retained events for nodes that connect later. Listens on
+  a `tcp://host:port` or `unix:///path` url.
+
+  A peer that doesn't keep up gets no more events but retained ones
+  once `MAX_BUFFER` bytes are waiting for it, and is disconnected at
+  `MAX_BUFFER * 4`. It then resyncs from the retained events when it
+  reconnects. The other nodes are told when a node disconnects.
+  """
+  MAX_BUFFER = 16 * 1024 * 1024
+
+  def __init__(self, url: str):
+    self.url = url
+    # identifies this run of the broker to reconnecting nodes
+    self.id = secrets.token_hex(8)
+    self.peers: Dict[asyncio.StreamWriter, Optional[str]] = {}
+    self.retained: Dict[str, bytes] = {}
+    self.dropped = 0
+    self.server: asyncio.AbstractServer
+
+  async def start(self):
+    self.server = await start_server(self._handle_peer, self.url)
+
+  async def close(self):
+    self.server.close()
+    await self.server.wait_closed()
+    parts = urlsplit(self.url)
+    if parts.scheme == 'unix' and os.path.exists(parts.path):
+      os.remove(parts.path)
+
+  def _retain(self, line: bytes):
+    event = json.loads(line)
+    if 'retain' in event:
+      # keep retained events in the order they were last updated
+      self.retained.pop(event['retain'], None)
+      self.retained[event['retain']] = line
+
+  # sends a line to every peer but `sender`
+  def _relay(self, sender: Optional[asyncio.StreamWriter], line: bytes, retained: bool):
+    for peer in list(self.peers):
+      if peer is sender or peer.is_closing():
+        continue
+      buffered = peer.transport.get_write_buffer_size()
+      if buffered > self.MAX_BUFFER * 4:
+        peer.close()
+      elif buffered > self.MAX_BUFFER and not retained:
+        self.dropped += 1
+      else:
+        peer.write(line)
+
+  async def _handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    writer.write(json.dumps({'op': 'hello', 'broker': self.id}).encode('utf-8') + b'\n')
+    for line in self.retained.values():
+      writer.write(line)
+    self.peers[writer] = None
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        retained = b'"retain"' in line
+        if retained:
+          self._retain(line)
+        if self.peers[writer] is None:
+          event = json.loads(line)
+          self.peers[writer] = event.get('node')
+          if event['op'] == 'hello':
+            continue
+        self._relay(writer, line, retained)
+    except (ConnectionError, ValueError):
+      pass
+    finally:
+      node = self.peers.pop(writer)
+      writer.close()
+      if node is not None:
+        lost = json.dumps({'op': 'node_lost', 'node': node}).encode('utf-8') + b'\n'
+        self._relay(writer, lost, False)
+
+#
+
+# events are single lines, this bounds the size of one event
+LINE_LIMIT = 16 * 1024 * 1024
+
+async def open_connection(url: str):
+  parts = urlsplit(url)
+  if parts.scheme == 'unix':
+    return await asyncio.open_unix_connection(parts.path, limit=LINE_LIMIT)
+  elif parts.scheme == 'tcp':
+    return await asyncio.open_connection(parts.hostname, parts.port, limit=LINE_LIMIT)
+  raise ValueError(f'unsupported bus url: {url}')
+
+async def start_server(handler: Callable, url: str) -> asyncio.AbstractServer:
+  parts = urlsplit(url)
+  if parts.scheme == 'unix':
+    if os.path.exists(parts.path):
+      os.remove(parts.path)
+    return await asyncio.start_unix_server(handler, path=parts.path, limit=LINE_LIMIT)
+  elif parts.scheme == 'tcp':
+    return await asyncio.start_server(handler, parts.hostname, parts.port, limit=LINE_LIMIT)
+  raise ValueError(f'unsupported bus url: {url}')
+
+def create_bus(url: str = None, node_id: str = None) -> MessageBus:
+  """
+  Creates the bus backend for `url`, which is either empty or 'local'
+  for the in-process bus or the url of a broker.
+  """
+  node_id = node_id or default_node_id()
+  if not url or url == 'local':
+    return LocalBus(node_id)
+  return BrokerBus(node_id, url)
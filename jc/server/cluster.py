@@ -0,0 +1,82 @@
+# Multi-process serving: worker processes that share the listening
+# port and a bus that relays stream events between them
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import ssl
+import tempfile
+from jc.server.bus import Broker, create_bus, default_node_id
+
+from typing import Any, List, Optional, Tuple
+
+
+def default_bus_url() -> str:
+  return f'unix://{os.path.join(tempfile.gettempdir(), f"jc-bus-{os.getpid()}.sock")}'
+
+#
+
+def run_worker(worker_id: int, host: str, port: int, cert_files: Optional[Tuple[str, str]], bus_url: str):
+  # imported here so the parent process doesn't need to
+  from jc.server.server import Server
+
+  if cert_files is None:
+    ssl_ctx = None
+  else:
+    ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_ctx.load_cert_chain(certfile=cert_files[0], keyfile=cert_files[1])
+
+  # names the log files this worker writes
+  os.environ['WORKER_ID'] = str(worker_id)
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  bus = create_bus(bus_url, f'{default_node_id()}-{worker_id}')
+  server = Server(host, port, ssl_ctx, bus=bus, reuse_port=True)
+  print(f'[worker {worker_id}] starting')
+  loop.run_until_complete(server.serve())
+  loop.add_signal_handler(signal.SIGTERM, loop.stop)
+  try:
+    loop.run_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    loop.run_until_complete(server.close())
+
+def run_workers(workers: int, host: str, port: int, cert_files: Optional[Tuple[str, str]], bus_url: str = None):
+  """
+  Starts `workers` server processes which all listen on the same port
+  (SO_REUSEPORT) and blocks until they exit. Without a `bus_url` the
+  parent process runs a broker on a unix socket for the workers.
+  """
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  broker = None
+  if not bus_url or bus_url == 'local':
+    bus_url = default_bus_url()
+    broker = Broker(bus_url)
+    loop.run_until_complete(broker.start())
+
+  procs: List[multiprocessing.Process] = []
+  for worker_id in range(workers):
+    proc = multiprocessing.Process(
+      target=run_worker,
+      args=(worker_id, host, port, cert_files, bus_url),
+      daemon=True
+    )
+    proc.start()
+    procs += [proc]
+
+  async def wait_workers(procs: List[Any]):
+    while any(proc.is_alive() for proc in procs):
+      await asyncio.sleep(1)
+
+  try:
+    loop.run_until_complete(wait_workers(procs))
+  except KeyboardInterrupt:
+    for proc in procs:
+      proc.terminate()
+  finally:
+    if broker is not None:
+      loop.run_until_complete(broker.close())
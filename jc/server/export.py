@@ -0,0 +1,85 @@
+# Streams byte ranges of a stream's log stores as a response body
+import asyncio
+import heapq
+import json
+import zlib
+
+from typing import Callable, Coroutine, Iterator, List, Optional, Tuple
+
+# bytes read and compressed at a time
+GZIP_CHUNK = 64 * 1024
+
+Ranges = List[Tuple[str, int, int]]
+
+
+def export_body(ranges: List[Ranges], gzip: bool = False) -> Callable[..., Coroutine]:
+  """
+  Returns the body of an export response for the (path, start, end)
+  ranges of each store from `LogReader.ranges`. The log of a single
+  store is sent with sendfile, the gzip variant is read and compressed
+  a chunk at a time in the executor. The logs of several stores are
+  merged by time a chunk at a time. Only one chunk is held in memory.
+  """
+  async def send_ranges(ws):
+    for path, start, end in ranges[0]:
+      with open(path, 'rb') as f:
+        await ws.send_file(f, start, end - start)
+
+  async def send_ranges_gzip(ws):
+    loop = asyncio.get_event_loop()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for path, start, end in ranges[0]:
+      with open(path, 'rb') as f:
+        f.seek(start)
+        while start < end:
+          size = min(GZIP_CHUNK, end - start)
+          data = await loop.run_in_executor(None, _read_compressed, f, size, compressor)
+          await ws.write_chunk(data)
+          start += size
+    await ws.write_chunk(compressor.flush())
+
+  async def send_merged(ws):
+    loop = asyncio.get_event_loop()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+    lines = heapq.merge(*[_read_lines(r) for r in ranges], key=_line_time)
+    while True:
+      data = await loop.run_in_executor(None, _read_merged, lines, compressor)
+      if data is None:
+        break
+      if len(data) > 0:
+        await ws.write_chunk(data)
+    if compressor is not None:
+      await ws.write_chunk(compressor.flush())
+
+  if len(ranges) == 0:
+    return _send_nothing
+  if len(ranges) > 1:
+    return send_merged
+  return send_ranges_gzip if gzip else send_ranges
+
+async def _send_nothing(ws):
+  pass
+
+def _read_compressed(f, size: int, compressor) -> bytes:
+  return compressor.compress(f.read(size))
+
+def _read_lines(ranges: Ranges) -> Iterator[bytes]:
+  for path, start, end in ranges:
+    with open(path, 'rb') as f:
+      f.seek(start)
+      while f.tell() < end:
+        yield f.readline()
+
+def _line_time(line: bytes) -> int:
+  return json.loads(line)['time']
+
+# the next chunk of merged lines, or None when there are no more
+def _read_merged(lines: Iterator[bytes], compressor) -> Optional[bytes]:
+  chunk = bytearray()
+  for line in lines:
+    chunk += line
+    if len(chunk) >= GZIP_CHUNK:
+      break
+  if len(chunk) == 0:
+    return None
+  return compressor.compress(bytes(chunk)) if compressor is not None else bytes(chunk)
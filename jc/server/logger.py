@@ -3,13 +3,30 @@ from __future__ import annotations
 
 import asyncio
 from asyncio.tasks import Task
+from collections import deque
+from time import monotonic
 import aiomysql
 import aiofiles
+import gzip
 import os
+import re
+import shutil
+import threading
 from datetime import datetime
+from jc.db import db
+from jc.server.logstore import LogStore, store_path, writer_name
 from jc.server.user import User
 
-from typing import List
+from typing import Deque, List, NamedTuple, Optional, Tuple
+
+
+class LogRecord(NamedTuple):
+  type: str
+  time: datetime
+  user: Optional[str]
+  text: str
+  # formatted text line
+  line: str
 
 
 class LoggerProtocol:
@@ -25,7 +42,7 @@ class LoggerProtocol:
   async def close(self):
     pass
 
-  async def log(self, _: List[str]):
+  async def log(self, _: List[LogRecord]):
     pass
 
 
@@ -33,91 +50,332 @@ class StdoutLogger(LoggerProtocol):
   async def create(id: str):
     return StdoutLogger(id)
 
-  async def log(self, strings: List[str]):
-    for string in strings:
-      print(string)
+  async def log(self, records: List[LogRecord]):
+    for record in records:
+      print(record.line)
 
 class FileLogger(LoggerProtocol):
+  """
+  Writes `{timestamp}_{id}_{writer}.log` files which are rotated once they
+  reach `ROTATE_BYTES` or are open for `ROTATE_INTERVAL` seconds. Rotated
+  files are gzipped in the executor and the oldest ones are deleted once
+  the files of the stream written by this process take more than
+  `RETAIN_BYTES`. Every process has its own files so rotating never
+  removes a file that another worker still appends to.
+
+  Files are only rotated between batches so the lines of a batch always
+  end up together and in order in a single file.
+  """
+  ROTATE_BYTES = 64 * 1024 * 1024
+  ROTATE_INTERVAL = 60 * 60
+  RETAIN_BYTES = 1024 * 1024 * 1024
+
   @staticmethod
   async def create(id: str):
     self = FileLogger(id)
-
-    logs_dir = os.getenv('LOGS_DIR', './')
-    os.makedirs(logs_dir, exist_ok=True)
-    path = os.path.join(logs_dir, self.name + '.log');
-    self.file = await aiofiles.open(path, 'w')
+    self.logs_dir = os.getenv('LOGS_DIR', './')
+    self.writer = writer_name()
+    self.pattern = re.compile(rf'\d{{14}}_{re.escape(id)}_{re.escape(self.writer)}\.log\.gz')
+    self.file = None
+    self.path = None
+    self.size = 0
+    self.opened = 0.0
+    self.compressing: List[asyncio.Future] = []
+    self.retention_lock = threading.Lock()
+    os.makedirs(self.logs_dir, exist_ok=True)
+    await self._open()
     return self
 
   async def close(self):
     await self.file.close()
     self.file = None
+    await asyncio.gather(*self.compressing)
 
-  async def log(self, strings: List[str]):
-    await self.file.writelines([f'{line}\n' for line in strings])
+  async def log(self, records: List[LogRecord]):
+    if self.size >= self.ROTATE_BYTES or (self.size > 0 and monotonic() - self.opened >= self.ROTATE_INTERVAL):
+      await self._rotate()
+    data = ''.join([f'{record.line}\n' for record in records]).encode('utf-8')
+    await self.file.write(data)
+    await self.file.flush()
+    self.size += len(data)
 
-#
+  async def _open(self):
+    self.name = f'{datetime.now().strftime("%Y%m%d%H%M%S")}_{self.id}_{self.writer}'
+    self.path = os.path.join(self.logs_dir, self.name + '.log')
+    self.file = await aiofiles.open(self.path, 'ab')
+    self.size = await self.file.tell()
+    self.opened = monotonic()
+
+  async def _rotate(self):
+    await self.file.close()
+    path = self.path
+    await self._open()
+    if path == self.path:
+      # rotated within the same second, keep appending
+      return
+    future = asyncio.get_event_loop().run_in_executor(None, self._compress, path)
+    self.compressing += [future]
+    future.add_done_callback(self.compressing.remove)
+
+  # runs in the executor
+  def _compress(self, path: str):
+    try:
+      with open(path, 'rb') as src, gzip.open(path + '.gz.tmp', 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+      os.replace(path + '.gz.tmp', path + '.gz')
+      os.remove(path)
+      with self.retention_lock:
+        self._apply_retention()
+    except OSError as e:
+      print(f'failed to compress {path}')
+      print(e)
+
+  def _apply_retention(self):
+    # compressed files of this stream and process, oldest first
+    names = sorted(name for name in os.listdir(self.logs_dir) if self.pattern.fullmatch(name))
+    paths = [os.path.join(self.logs_dir, name) for name in names]
+    sizes = [os.path.getsize(path) for path in paths]
+    total = self.size + sum(sizes)
+    for path, size in zip(paths, sizes):
+      if total <= self.RETAIN_BYTES:
+        break
+      os.remove(path)
+      total -= size
+
+class DatabaseLogger(LoggerProtocol):
+  """
+  Writes each batch to the chat_messages table with one multi-row insert.
+  Failed writes are retried with a backoff, this only delays the writer
+  task of this sink.
+  """
+  RETRIES = 3
+  RETRY_DELAY = 0.5
 
-class Logger:
-  def __init__(self) -> None:
-    self.org_id: str
-    self.loggers: List[LoggerProtocol]
-    self.queue: List[str]
-    self.lock: asyncio.Lock
-    self.event: asyncio.Event
-    self.task: Task
-  
   @staticmethod
-  async def create(org_id: str) -> Logger:
-    self = Logger()
-    self.org_id = org_id
-    
-    results = await asyncio.wait([
-      StdoutLogger.create(org_id),
-      FileLogger.create(org_id),
-    ])
-    self.loggers = [res.result() for res in results[0]]
-    self.queue = []
-    self.lock = asyncio.Lock()
-    self.event = asyncio.Event()
-    self.task = asyncio.get_event_loop().create_task(self._writer_task())
+  async def create(id: str):
+    return DatabaseLogger(id)
 
+  async def log(self, records: List[LogRecord]):
+    rows = [(self.id, r.type, r.user, r.text, r.time) for r in records]
+    for attempt in range(self.RETRIES + 1):
+      try:
+        await db.save_chat_messages(rows)
+        return
+      except Exception:
+        if attempt == self.RETRIES:
+          raise
+        await asyncio.sleep(self.RETRY_DELAY * 2 ** attempt)
 
+class StoreLogger(LoggerProtocol):
+  """
+  Appends to the segmented log store of the stream which answers
+  history queries. Every process writes its own store in the stream's
+  directory. File I/O runs in the executor.
+  """
+  @staticmethod
+  async def create(id: str):
+    self = StoreLogger(id)
+    loop = asyncio.get_event_loop()
+    path = os.path.join(store_path(id), writer_name())
+    self.store = await loop.run_in_executor(None, LogStore.open, path)
     return self
-  
+
   async def close(self):
+    await asyncio.get_event_loop().run_in_executor(None, self.store.close)
+
+  async def log(self, records: List[LogRecord]):
+    rows = [(int(r.time.timestamp() * 1000), r.type, r.user, r.text) for r in records]
+    await asyncio.get_event_loop().run_in_executor(None, self.store.append, rows)
+
+# sinks that can be enabled with LOG_SINKS
+SINKS = {
+  'stdout': StdoutLogger,
+  'file': FileLogger,
+  'db': DatabaseLogger,
+  'store': StoreLogger,
+}
+
+#
+
+class LogOverflow:
+  DROP = 'drop'   # drop new lines
+  BLOCK = 'block' # make writers wait in `Logger.wait_writable`
+
+
+class SinkWriter:
+  """
+  Hands batches to a single sink from a dedicated task so a slow sink
+  only delays its own writes.
+  """
+  MAX_BATCH = 4096
+
+  def __init__(self, sink: LoggerProtocol):
+    self.sink = sink
+    self.batches: Deque[Tuple[float, List[LogRecord]]] = deque()
+    self.pending = 0
+    self.event = asyncio.Event()
+    self.idle = asyncio.Event()
+    self.idle.set()
+    self.on_written = None
+    # metrics
+    self.flushes = 0
+    self.errors = 0
+    self.total_latency = 0.0
+    self.max_latency = 0.0
+    self.task: Task = asyncio.get_event_loop().create_task(self._writer_task())
+
+  def put(self, batch: List[LogRecord]):
+    self.batches.append((monotonic(), batch))
+    self.pending += len(batch)
+    self.idle.clear()
+    self.event.set()
+
+  async def close(self, timeout: float):
+    try:
+      await asyncio.wait_for(self.idle.wait(), timeout)
+    except asyncio.TimeoutError:
+      print(f'{type(self.sink).__name__} dropped {self.pending} lines on close')
     self.task.cancel()
     try:
       await self.task
     except asyncio.CancelledError:
       pass
-    await asyncio.wait([logger.close() for logger in self.loggers])
+    await self.sink.close()
+
+  def metrics(self) -> dict:
+    return {
+      'pending': self.pending,
+      'flushes': self.flushes,
+      'errors': self.errors,
+      'avg_flush_ms': self.total_latency / max(self.flushes, 1) * 1000,
+      'max_flush_ms': self.max_latency * 1000,
+    }
 
-  # batch writes
   async def _writer_task(self):
     while True:
       await self.event.wait()
       self.event.clear()
-      await asyncio.sleep(1)
-      
-      await self.lock.acquire()
-      queue = self.queue.copy()
-      self.queue = []
-      self.lock.release()
-      # log the message
-      await asyncio.wait([l.log(queue) for l in self.loggers])
-  
-  def _log(self, type: str, msg: str):
+      while len(self.batches) > 0:
+        # everything that queued up while the last write was
+        # in progress is written together
+        queued_at, batch = self.batches.popleft()
+        while len(self.batches) > 0 and len(batch) < self.MAX_BATCH:
+          batch = batch + self.batches.popleft()[1]
+        try:
+          await self.sink.log(batch)
+        except Exception as e:
+          self.errors += 1
+          print(f'{type(self.sink).__name__} failed to write {len(batch)} lines')
+          print(e)
+        latency = monotonic() - queued_at
+        self.flushes += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.pending -= len(batch)
+        if self.on_written is not None:
+          self.on_written()
+      self.idle.set()
+
+
+class Logger:
+  """
+  Buffers log lines and flushes them in batches to every sink, either
+  when `BATCH_SIZE` lines are buffered or `FLUSH_INTERVAL` seconds after
+  the first buffered line, whichever comes first. At most `MAX_PENDING`
+  lines are held for the slowest sink, past that the overflow policy
+  applies.
+  """
+  BATCH_SIZE = 256
+  FLUSH_INTERVAL = 1
+  MAX_PENDING = 10000
+  OVERFLOW = LogOverflow.DROP
+  CLOSE_TIMEOUT = 5
+
+  def __init__(self) -> None:
+    self.org_id: str
+    self.writers: List[SinkWriter]
+    self.buffer: List[LogRecord]
+    self.handle: Optional[asyncio.TimerHandle]
+    self.writable: asyncio.Event
+    self.dropped: int
+
+  @staticmethod
+  async def create(org_id: str) -> Logger:
+    self = Logger()
+    self.org_id = org_id
+
+    sinks = os.getenv('LOG_SINKS', 'stdout,file,store').split(',')
+    loggers = await asyncio.gather(*[SINKS[sink.strip()].create(org_id) for sink in sinks])
+    self.writers = [SinkWriter(logger) for logger in loggers]
+    for writer in self.writers:
+      writer.on_written = self._on_written
+    self.buffer = []
+    self.handle = None
+    self.writable = asyncio.Event()
+    self.writable.set()
+    self.dropped = 0
+    return self
+
+  async def close(self):
+    self.flush()
+    await asyncio.gather(*[writer.close(self.CLOSE_TIMEOUT) for writer in self.writers])
+
+  def flush(self):
+    if self.handle is not None:
+      self.handle.cancel()
+      self.handle = None
+    if len(self.buffer) == 0:
+      return
+
+    batch = self.buffer
+    self.buffer = []
+    for writer in self.writers:
+      writer.put(batch)
+
+  # lines that are buffered or not yet written by the slowest sink
+  def pending(self) -> int:
+    return len(self.buffer) + max([writer.pending for writer in self.writers], default=0)
+
+  async def wait_writable(self):
+    """
+    With the block policy this waits until there is room for more lines,
+    otherwise it returns right away.
+    """
+    if self.OVERFLOW == LogOverflow.BLOCK:
+      await self.writable.wait()
+
+  def metrics(self) -> dict:
+    return {
+      'buffered': len(self.buffer),
+      'pending': self.pending(),
+      'dropped': self.dropped,
+      'sinks': {type(w.sink).__name__: w.metrics() for w in self.writers},
+    }
+
+  def _on_written(self):
+    if self.pending() < self.MAX_PENDING:
+      self.writable.set()
+
+  def _log(self, type: str, user: Optional[str], text: str):
+    if self.pending() >= self.MAX_PENDING:
+      if self.OVERFLOW == LogOverflow.DROP:
+        self.dropped += 1
+        return
+      self.writable.clear()
+
     time = datetime.now()
+    msg = text if user is None else f'{user}: {text}'
     log = f'[{type}] {time.strftime("%Y-%m-%d %H:%M:%S")} | {msg}'
-    while self.lock.locked():
-      continue
-    self.queue += [log]
-    self.event.set()
-  
+    self.buffer += [LogRecord(type, time, user, text, log)]
+    if len(self.buffer) >= self.BATCH_SIZE:
+      self.flush()
+    elif self.handle is None:
+      self.handle = asyncio.get_event_loop().call_later(self.FLUSH_INTERVAL, self.flush)
+
   #
 
-  def log_message(self, user: User, message: str): 
-    self._log('message', f'{user.name}: {message}')
+  def log_message(self, user: User, message: str):
+    self._log('message', user.name, message)
 
   def log_status(self, status: str):
-    self._log('status', status)
+    self._log('status', None, status)
@@ -0,0 +1,327 @@
+# Append-only chat log split into segments with a sparse time index
+from __future__ import annotations
+
+import heapq
+import itertools
+import json
+import mmap
+import os
+import socket
+import struct
+import threading
+from bisect import bisect_left
+
+from typing import Dict, List, Optional, Tuple
+
+# (time in ms, byte offset in the segment)
+INDEX_ENTRY = struct.Struct('<qQ')
+
+
+def store_path(stream_id: str) -> str:
+  return os.path.join(os.getenv('LOGS_DIR', './'), 'streams', stream_id)
+
+def writer_name() -> str:
+  """
+  Names the files a process writes so that worker processes never
+  write to the same file. It's the same after a restart so a worker
+  continues its own files.
+  """
+  return f'{socket.gethostname()}-{os.getenv("WORKER_ID", "0")}'
+
+
+class Segment:
+  """
+  A log file with one json record per line and an index file with an
+  entry for roughly every `LogStore.INDEX_INTERVAL` bytes of the log.
+  Only the first `size` bytes are read, anything past that is still
+  being written.
+  """
+  def __init__(self, path: str, start: int):
+    self.path = path
+    self.start = start
+    self.size = 0
+    self.times: List[int] = []
+    self.offsets: List[int] = []
+    self.loaded = True
+
+  @property
+  def index_path(self) -> str:
+    return self.path[:-len('.log')] + '.idx'
+
+  # the index is only read by `load_index` once the segment is needed
+  @staticmethod
+  def load(path: str) -> Segment:
+    start = int(os.path.basename(path).split('_')[0])
+    self = Segment(path, start)
+    self.loaded = False
+    return self
+
+  def load_index(self):
+    times = []
+    offsets = []
+    if os.path.exists(self.index_path):
+      with open(self.index_path, 'rb') as f:
+        data = f.read()
+      # a torn entry at the end is ignored
+      end = len(data) - len(data) % INDEX_ENTRY.size
+      for time, offset in INDEX_ENTRY.iter_unpack(data[:end]):
+        times += [time]
+        offsets += [offset]
+    # read after the index so the index never points past the size
+    self.size = os.path.getsize(self.path)
+    self.times = times
+    self.offsets = offsets
+    self.loaded = True
+
+  # time of the last complete record
+  def last_time(self) -> int:
+    if self.size == 0:
+      return self.start
+    with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ) as m:
+      end = m.rfind(b'\n')
+      if end == -1:
+        return self.start
+      return json.loads(m[m.rfind(b'\n', 0, end) + 1:end])['time']
+
+  def locate(self, time: int, size: int, entries: int) -> int:
+    """
+    Returns the offset of the first record at or after `time`. Scanning
+    starts at the last index entry before `time` so at most one index
+    interval is read in vain.
+    """
+    i = bisect_left(self.times, time, 0, entries) - 1
+    pos = self.offsets[i] if i >= 0 else 0
+    if size == 0:
+      return pos
+    with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as m:
+      while pos < size:
+        end = m.find(b'\n', pos, size)
+        if end == -1 or json.loads(m[pos:end])['time'] >= time:
+          break
+        pos = end + 1
+    return pos
+
+  # returns the records in [since, until] and whether the end of the range was reached
+  def read(self, since: int, until: int, limit: int, size: int, entries: int) -> Tuple[List[dict], bool]:
+    records = []
+    pos = self.locate(since, size, entries)
+    if pos >= size:
+      return records, False
+
+    with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as m:
+      while pos < size and len(records) < limit:
+        end = m.find(b'\n', pos, size)
+        if end == -1:
+          break
+        record = json.loads(m[pos:end])
+        pos = end + 1
+        if record['time'] > until:
+          return records, True
+        records += [record]
+    return records, False
+
+
+class LogStore:
+  """
+  Chat log of a stream stored as a directory of segments named after
+  the time of their first record and their number. Records are only
+  ever appended and their times never decrease, so a time range is
+  found with a binary search over the segments and then over the
+  segment index.
+
+  `append` and `query` block on file I/O and are meant to be run in
+  an executor, they can be called from different threads. A store
+  has a single writer, other processes only read it.
+  """
+  SEGMENT_BYTES = 16 * 1024 * 1024
+  INDEX_INTERVAL = 4096
+
+  def __init__(self, path: str):
+    self.path = path
+    self.segments: List[Segment] = []
+    self.last_time = 0
+    self.file = None
+    self.index_file = None
+    self.last_indexed = 0
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def open(path: str) -> LogStore:
+    self = LogStore(path)
+    os.makedirs(path, exist_ok=True)
+    names = sorted(name for name in os.listdir(path) if name.endswith('.log'))
+    self.segments = [Segment.load(os.path.join(path, name)) for name in names]
+    if len(self.segments) > 0:
+      self.segments[-1].load_index()
+      self.last_time = self.segments[-1].last_time()
+    return self
+
+  def refresh(self):
+    """
+    Picks up what the writer appended since the store was opened, for
+    stores written by another process.
+    """
+    names = sorted(name for name in os.listdir(self.path) if name.endswith('.log'))
+    with self.lock:
+      known = len(self.segments)
+      if known > 0:
+        # the last segment may have grown
+        self.segments[-1].loaded = False
+      self.segments += [Segment.load(os.path.join(self.path, name)) for name in names[known:]]
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.index_file.close()
+      self.file = None
+      self.index_file = None
+
+  def append(self, records: List[Tuple[int, str, Optional[str], str]]):
+    """
+    Appends (time in ms, type, user, text) records. The data is flushed
+    before it is indexed and before readers can see it.
+    """
+    data = bytearray()
+    index = bytearray()
+    segment = self.segments[-1] if self.file is not None else None
+    offset = segment.size if segment is not None else 0
+    times: List[int] = []
+    offsets: List[int] = []
+    for time, type, user, text in records:
+      # keeps times ordered if the clock goes backwards
+      time = max(time, self.last_time)
+      self.last_time = time
+      line = json.dumps({'time': time, 'type': type, 'user': user, 'text': text}).encode('utf-8') + b'\n'
+
+      if segment is None or (offset > 0 and offset + len(line) > self.SEGMENT_BYTES):
+        self._write(segment, data, index, times, offsets)
+        data, index, times, offsets = bytearray(), bytearray(), [], []
+        segment = self._roll(time)
+        offset = 0
+
+      if offset == 0 or offset - self.last_indexed >= self.INDEX_INTERVAL:
+        index += INDEX_ENTRY.pack(time, offset)
+        times += [time]
+        offsets += [offset]
+        self.last_indexed = offset
+      data += line
+      offset += len(line)
+    self._write(segment, data, index, times, offsets)
+
+  def query(self, since: int, until: int, limit: int) -> List[dict]:
+    records = []
+    for segment in self._segments(since):
+      if segment.start > until or len(records) >= limit:
+        break
+      size, entries = self._snapshot(segment)
+      result, done = segment.read(since, until, limit - len(records), size, entries)
+      records += result
+      if done:
+        break
+    return records
+
+  def ranges(self, since: int, until: int) -> List[Tuple[str, int, int]]:
+    """
+    Returns the (path, start, end) byte ranges of the segments that
+    hold the records in [since, until], for sending the raw log.
+    """
+    ranges = []
+    for segment in self._segments(since):
+      if segment.start > until:
+        break
+      size, entries = self._snapshot(segment)
+      start = segment.locate(since, size, entries)
+      end = segment.locate(until + 1, size, entries)
+      if end > start:
+        ranges += [(segment.path, start, end)]
+    return ranges
+
+  # the segments that can hold records after `since`
+  def _segments(self, since: int) -> List[Segment]:
+    with self.lock:
+      segments = list(self.segments)
+    starts = [s.start for s in segments]
+    return segments[max(bisect_left(starts, since) - 1, 0):]
+
+  # the size and number of index entries of what was fully
+  # written when this was called
+  def _snapshot(self, segment: Segment) -> Tuple[int, int]:
+    with self.lock:
+      if not segment.loaded:
+        segment.load_index()
+      return segment.size, len(segment.times)
+
+  def _roll(self, time: int) -> Segment:
+    self.close()
+    name = f'{time:015d}_{len(self.segments):06d}.log'
+    segment = Segment(os.path.join(self.path, name), time)
+    self.file = open(segment.path, 'ab')
+    self.index_file = open(segment.index_path, 'ab')
+    self.last_indexed = 0
+    with self.lock:
+      self.segments += [segment]
+    return segment
+
+  def _write(self, segment: Optional[Segment], data: bytes, index: bytes,
+             times: List[int], offsets: List[int]):
+    if segment is None or len(data) == 0:
+      return
+    self.file.write(data)
+    self.file.flush()
+    self.index_file.write(index)
+    self.index_file.flush()
+    with self.lock:
+      segment.times += times
+      segment.offsets += offsets
+      segment.size += len(data)
+
+
+class LogReader:
+  """
+  Reads the log of a stream from the stores of every process that
+  wrote to it, one directory per writer. Queries go to every store and
+  the results are merged by time.
+  """
+  def __init__(self, path: str):
+    self.path = path
+    self.stores: Dict[str, LogStore] = {}
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def open(path: str) -> LogReader:
+    self = LogReader(path)
+    self.refresh()
+    return self
+
+  def refresh(self):
+    """
+    Opens the stores of new writers and picks up what was appended
+    to the others. Only segment names are listed, indexes are read
+    when a query needs them.
+    """
+    names = os.listdir(self.path)
+    paths = [os.path.join(self.path, name) for name in names]
+    paths = [path for path in paths if os.path.isdir(path)]
+    # logs from before there was a directory per writer
+    if any(name.endswith('.log') for name in names):
+      paths += [self.path]
+    with self.lock:
+      for path in paths:
+        if path in self.stores:
+          self.stores[path].refresh()
+        else:
+          self.stores[path] = LogStore.open(path)
+
+  def query(self, since: int, until: int, limit: int) -> List[dict]:
+    with self.lock:
+      stores = list(self.stores.values())
+    results = [store.query(since, until, limit) for store in stores]
+    merged = heapq.merge(*results, key=lambda record: record['time'])
+    return list(itertools.islice(merged, limit))
+
+  # the byte ranges of `LogStore.ranges` of every store that has any
+  def ranges(self, since: int, until: int) -> List[List[Tuple[str, int, int]]]:
+    with self.lock:
+      stores = list(self.stores.values())
+    ranges = [store.ranges(since, until) for store in stores]
+    return [r for r in ranges if len(r) > 0]
@@ -1,7 +1,38 @@
+from __future__ import annotations
+
 import json
-from typing import List, Tuple
+from websockets.frames import OP_BINARY, OP_TEXT, Opcode
+from typing import Callable, Dict, List, Tuple, Union
+
+# orjson is used when it's installed, otherwise the standard library
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# needed for the msgpack subprotocol
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+if orjson is not None:
+  _loads = orjson.loads
+  _dumps = orjson.dumps
+else:
+  _loads = json.loads
+
+  def _dumps(obj: object) -> bytes:
+    return json.dumps(obj).encode('utf-8')
 
 """
+==== Encodings ====
+
+Messages are json text frames by default. Clients can ask for the
+'jc.msgpack' subprotocol during the websocket handshake to get the
+same messages as MessagePack binary frames, and then send theirs as
+binary frames too. 'jc.json' selects json explicitly.
+
 ==== Message Types ====
 
 --- SETUP ---
@@ -10,6 +41,7 @@ client -> server
   type: 'setup',
   name: string,
   email: string,
+  batch?: bool,
 }
 
 --- TEXT ---
@@ -24,21 +56,77 @@ server -> client
   user: str,
   time: str,
   text: str,
+  seq: int,
+  segments?: List[str | {emote: str}],
+}
+`segments` is the text split into plain text and the emotes it
+contains, by name, so they can be looked up in whatever emote set the
+client has. It's left out when the text has no emotes.
+
+--- TEXT_BATCH ---
+server -> client (only to clients that set `batch` during setup)
+{
+  type: 'text_batch',
+  messages: List[TEXT],
+}
+
+--- HISTORY ---
+server -> client (recent messages, sent when connecting)
+{
+  type: 'history',
+  messages: List[TEXT],
 }
 
 --- EMOTES ---
-server -> client
+server -> client (when connecting and when the set changes, emotes are
+                  sorted by name and the names are unique)
 {
   type: 'emotes',
+  version: str,
   emotes: List[Tuple[str, str]]
 }
 
+--- EMOTES_DELTA ---
+server -> client (instead of EMOTES when the client has `base` cached,
+                  added emotes replace the emotes with the same name)
+{
+  type: 'emotes_delta',
+  base: str,
+  version: str,
+  added: List[Tuple[str, str]],
+  removed: List[str]
+}
+Clients that have an emote set cached can connect with
+`?emotes_version=<version>` to get nothing if it's still current or a
+delta if it's recent, instead of the full set.
+
 --- VIEWERS ---
 server -> client
 {
   type: 'viewers',
   count: int
 }
+
+--- SESSION ---
+server -> client (after setup and after resuming)
+{
+  type: 'session',
+  token: str,
+}
+A client that reconnects within a few minutes can connect with
+`?resume=<token>&seq=<seq of the last text message received>`
+(and optionally `&emotes_version=<cached version>`) to skip the
+setup. It then receives the messages it missed in a
+'history' message instead of the recent messages and a new token.
+If the session can't be resumed the connection continues as new.
+Every node keeps the sessions and recent messages, so the client can
+resume on any node that was up while it was gone. Messages keep the
+sequence number of the node they were sent on, which is the same on
+every node unless messages of the stream are sent on several nodes at
+the same moment. Then a node may number some of them differently and
+a client resuming on another node can miss or repeat a few of them.
+Sessions are only kept in memory and don't survive a restart of all
+nodes at once.
 """
 
 class InvalidMessageError(Exception):
@@ -47,8 +135,12 @@ class InvalidMessageError(Exception):
 class MessageType:
   SETUP = 'setup'     # client --> server
   TEXT = 'text'       # client <-> server
+  TEXT_BATCH = 'text_batch' # server --> client
+  HISTORY = 'history' # server --> client
   EMOTES  = 'emotes'  # server --> client
+  EMOTES_DELTA = 'emotes_delta' # server --> client
   VIEWERS = 'viewers' # server --> client
+  SESSION = 'session' # server --> client
 
 
 # client message types
@@ -64,38 +156,49 @@ client_messages = {
   }
 }
 
-def validate_obj(template, obj):
-  for key in template:
-    if key not in obj:
-      return False
-
-    value = template[key]
+def compile_validator(template: dict) -> Callable[[dict], bool]:
+  """
+  Turns a message template into a function that checks a decoded
+  message against it. Constant values must be equal and types must
+  match exactly, like in the templates above.
+  """
+  constants = []
+  types = []
+  for key, value in template.items():
     if type(value) in [str, int, float, bool]:
-      if value != obj[key]:
-        return False
+      constants += [(key, value)]
     elif type(value) == type:
-      if type(obj[key]) != value:
-        return False
+      types += [(key, value)]
     else:
-      return False
-  return True
+      raise ValueError(f'invalid template value for {key!r}')
+
+  def validate(obj: dict) -> bool:
+    return (all(obj.get(key) == value for key, value in constants) and
+            all(type(obj.get(key)) is value for key, value in types))
+  return validate
+
+# compiled once, keyed by message type
+validators = {type: compile_validator(template) for type, template in client_messages.items()}
 
 """
 Validates a websocket message string and returns
 the message as a json object. If the message is
 invalid, an InvalidMessageError exception is raised.
 """
-def parse_message(msg: str) -> object:
+def parse_message(msg, codec: Codec = None) -> object:
   try:
-    obj = json.loads(msg)
-  except:
+    obj = (codec or JSON).decode(msg)
+  except ValueError:
     raise InvalidMessageError('invalid json')
 
-  if 'type' not in obj or obj['type'] not in client_messages:
+  if type(obj) is not dict or type(obj.get('type')) is not str:
+    raise InvalidMessageError('invalid message')
+  validator = validators.get(obj['type'])
+  if validator is None:
     raise InvalidMessageError('invalid or missing message type')
-  if validate_obj(client_messages[obj['type']], obj):
-    return obj
-  return InvalidMessageError('invalid message format')
+  if not validator(obj):
+    raise InvalidMessageError('invalid message format')
+  return obj
 
 """
 Validates a websocket message string and returns
@@ -103,33 +206,134 @@ the message as a json object. If the message is
 invalid or of a different type than was expected, 
 an InvalidMessageError exception is raised.
 """
-def expect_message(msg: str, type: str) -> object:
-  obj = parse_message(msg)
+def expect_message(msg, type: str, codec: Codec = None) -> object:
+  obj = parse_message(msg, codec)
   if obj['type'] != type:
     raise InvalidMessageError('invalid message type')
   return obj
 
 #
 
-def text_message(user: str, time: str, text: str) -> object:
+class Codec:
+  """
+  Encoding of the messages on a connection, chosen by the subprotocol
+  the client asked for during the websocket handshake.
+  """
+  def __init__(self, subprotocol: str, opcode: Opcode):
+    self.subprotocol = subprotocol
+    self.opcode = opcode
+
+  def encode(self, obj: object) -> bytes:
+    pass
+
+  # raises ValueError if `data` can't be decoded
+  def decode(self, data) -> object:
+    pass
+
+  def encode_list(self, type: str, payloads: List[bytes]) -> bytes:
+    """
+    Builds an encoded {type, messages} message out of already
+    encoded messages without serializing them again.
+    """
+    pass
+
+class JsonCodec(Codec):
+  def encode(self, obj: object) -> bytes:
+    return _dumps(obj)
+
+  def decode(self, data) -> object:
+    return _loads(data)
+
+  def encode_list(self, type: str, payloads: List[bytes]) -> bytes:
+    return b'{"type":"%s","messages":[%s]}' % (type.encode('utf-8'), b','.join(payloads))
+
+class MsgpackCodec(Codec):
+  def encode(self, obj: object) -> bytes:
+    return msgpack.packb(obj)
+
+  def decode(self, data) -> object:
+    if not isinstance(data, bytes):
+      raise ValueError('expected a binary message')
+    try:
+      return msgpack.unpackb(data)
+    except Exception as e:
+      raise ValueError(str(e))
+
+  def encode_list(self, type: str, payloads: List[bytes]) -> bytes:
+    # msgpack values can be concatenated, only the array header is needed
+    count = len(payloads)
+    if count < 16:
+      header = bytes([0x90 | count])
+    elif count < 2 ** 16:
+      header = b'\xdc' + count.to_bytes(2, 'big')
+    else:
+      header = b'\xdd' + count.to_bytes(4, 'big')
+    prefix = b'\x82' + msgpack.packb('type') + msgpack.packb(type) + msgpack.packb('messages')
+    return prefix + header + b''.join(payloads)
+
+JSON = JsonCodec('jc.json', OP_TEXT)
+MSGPACK = MsgpackCodec('jc.msgpack', OP_BINARY) if msgpack is not None else None
+
+# subprotocols offered to clients, in order of preference
+CODECS: Dict[str, Codec] = {codec.subprotocol: codec for codec in [MSGPACK, JSON] if codec is not None}
+SUBPROTOCOLS = list(CODECS)
+
+#
+
+def text_message(user: str, time: str, text: str,
+                 segments: List[Union[str, Dict[str, str]]] = None) -> object:
   obj = {
     'type': MessageType.TEXT,
     'user': user,
     'time': time,
     'text': text
   }
+  if segments is not None:
+    obj['segments'] = segments
   return obj
 
-def emotes_message(emotes: List[Tuple[str, str]]) -> object:
+def text_batch_message(messages: List[object]) -> object:
+  obj = {
+    'type': MessageType.TEXT_BATCH,
+    'messages': messages
+  }
+  return obj
+
+def history_message(messages: List[object]) -> object:
+  obj = {
+    'type': MessageType.HISTORY,
+    'messages': messages
+  }
+  return obj
+
+def emotes_message(version: str, emotes: List[Tuple[str, str]]) -> object:
   obj = {
     'type': MessageType.EMOTES,
+    'version': version,
     'emotes': emotes
   }
   return obj
 
+def emotes_delta_message(base: str, version: str, added: List[Tuple[str, str]], removed: List[str]) -> object:
+  obj = {
+    'type': MessageType.EMOTES_DELTA,
+    'base': base,
+    'version': version,
+    'added': added,
+    'removed': removed
+  }
+  return obj
+
 def viewers_message(viewers: int) -> object:
   obj = {
     'type': MessageType.VIEWERS,
     'viewers': viewers
   }
   return obj
+
+def session_message(token: str) -> object:
+  obj = {
+    'type': MessageType.SESSION,
+    'token': token
+  }
+  return obj
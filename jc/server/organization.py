@@ -1,26 +1,142 @@
 import asyncio
+import hashlib
+import json
+import re
+from collections import OrderedDict
 from jc.db import db
-from typing import List, Set, Tuple
+from jc.server import message
+from jc.server.broadcast import PreparedMessage
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+# emotes are whole whitespace separated words
+WORD_PATTERN = re.compile(r'\S+')
+
+
+class EmoteMatcher:
+  """
+  Splits chat text into segments of plain text and the names of the
+  emotes it contains, so clients don't have to scan each line against
+  the whole emote set. Built once per emote set.
+  """
+  def __init__(self, emotes: List[Tuple[str, str]]):
+    self.names = set(name for name, _ in emotes)
+
+  def tokenize(self, text: str) -> Optional[List[Union[str, Dict[str, str]]]]:
+    """
+    Returns the segments of `text`, or nothing if it has no emotes.
+    Each word is a single lookup so this is linear in the length of
+    the text regardless of how many emotes there are.
+    """
+    if len(self.names) == 0:
+      return None
+    segments = []
+    start = 0
+    for match in WORD_PATTERN.finditer(text):
+      name = match.group()
+      if name not in self.names:
+        continue
+      if match.start() > start:
+        segments += [text[start:match.start()]]
+      segments += [{'emote': name}]
+      start = match.end()
+    if len(segments) == 0:
+      return None
+    if start < len(text):
+      segments += [text[start:]]
+    return segments
+
 
 class Organization:
+  # number of previous emote sets that clients can get a delta from
+  EMOTES_HISTORY = 8
+
   def __init__(self):
     self.id: str
     self.emotes: List[Tuple[str, str]]
+    self.emotes_version: str
+    self.emotes_matcher: EmoteMatcher
+    self.emotes_message: PreparedMessage
+    self.emotes_history: OrderedDict
+    self.emotes_deltas: Dict[str, PreparedMessage]
     self.streams: Set
 
   @staticmethod
-  async def create(id: str):
+  async def create(id: str, emotes: List[Tuple[str, str]] = None):
     self = Organization()
     self.id = id
-    self.emotes = await db.get_emotes(id)
+    if emotes is None:
+      emotes = await db.get_emotes(id)
+    self.emotes_version = None
+    self.emotes_history = OrderedDict()
+    self.set_emotes(emotes)
     self.streams = set()
     return self
 
   async def close(self):
-    await asyncio.wait([stream.close() for stream in self.streams])
+    if len(self.streams) > 0:
+      await asyncio.wait([stream.close() for stream in self.streams])
 
   def add_stream(self, stream):
     self.streams.add(stream)
 
   def remove_stream(self, stream):
     self.streams.remove(stream)
+
+  #
+
+  def set_emotes(self, emotes: List[Tuple[str, str]], added: List[Tuple[str, str]] = None,
+                 removed: List[str] = None):
+    """
+    Replaces the emote set and rebuilds the cached emotes message. The
+    set is kept sorted by name and the version is a hash of the sorted
+    set, so it's the same on every node whatever order the emotes were
+    loaded or saved in. When the difference to the previous set is
+    already known it can be passed as `added` and `removed`.
+    """
+    emotes = sorted(dict((name, url) for name, url in emotes).items())
+    # always hashed with the standard json encoder so nodes with
+    # different message codecs agree on the version
+    encoded = json.dumps(emotes)
+    version = hashlib.sha1(encoded.encode('utf-8')).hexdigest()[:16]
+    if version == self.emotes_version:
+      return
+    if self.emotes_version is not None:
+      self.emotes_history.pop(self.emotes_version, None)
+      self.emotes_history[self.emotes_version] = self.emotes
+      while len(self.emotes_history) > self.EMOTES_HISTORY:
+        self.emotes_history.popitem(last=False)
+
+    base = self.emotes_version
+    self.emotes = emotes
+    self.emotes_version = version
+    self.emotes_matcher = EmoteMatcher(emotes)
+    self.emotes_message = PreparedMessage(message.emotes_message(version, emotes))
+    self.emotes_deltas = {}
+    if base is not None and added is not None and removed is not None:
+      self._add_delta(base, [tuple(emote) for emote in added], removed)
+
+  def emotes_update(self, version: Optional[str]) -> Optional[PreparedMessage]:
+    """
+    Returns the message that brings a client with the emote set `version`
+    up to date: nothing if it's current, a delta if `version` is a recent
+    set or else the full set.
+    """
+    if version == self.emotes_version:
+      return None
+    if version not in self.emotes_history:
+      return self.emotes_message
+
+    if version not in self.emotes_deltas:
+      old = self.emotes_history[version]
+      old_set = set(old)
+      new_names = set(name for name, _ in self.emotes)
+      added = [emote for emote in self.emotes if emote not in old_set]
+      removed = [name for name, _ in old if name not in new_names]
+      self._add_delta(version, added, removed)
+    return self.emotes_deltas[version]
+
+  def _add_delta(self, base: str, added: List[Tuple[str, str]], removed: List[str]):
+    msg = message.emotes_delta_message(base, self.emotes_version, added, removed)
+    delta = PreparedMessage(msg)
+    delta.full = self.emotes_message
+    self.emotes_deltas[base] = delta
@@ -0,0 +1,126 @@
+# Bounded per-connection outbound message queue
+from __future__ import annotations
+
+import asyncio
+from asyncio.tasks import Task
+from collections import deque
+from jc.server.broadcast import PreparedMessage
+from jc.server.message import MessageType
+from websockets.exceptions import ConnectionClosed
+
+from typing import Callable, Deque, Dict, List
+
+
+class OverflowPolicy:
+  DROP_OLDEST = 'drop_oldest'   # drop the oldest queued message
+  DROP_CHAT = 'drop_chat'       # drop chat messages, keep system messages
+  DISCONNECT = 'disconnect'     # close the connection
+
+  ALL = [DROP_OLDEST, DROP_CHAT, DISCONNECT]
+
+
+class Outbox:
+  """
+  Holds the messages waiting to be written to a single connection.
+  Messages are put on the queue without blocking and a dedicated
+  writer task drains it. When the queue is full the overflow policy
+  decides what is dropped.
+
+  Messages are split into lanes that are written in priority order:
+  - latest-wins slots for state messages (viewer count, emotes) where
+    a newer value replaces an older one that wasn't sent yet
+  - a control lane for other system messages
+  - a chat lane for text messages
+  """
+  # message types where only the newest value matters,
+  # mapped to the slot they replace
+  LATEST_WINS = {
+    MessageType.VIEWERS: 'viewers',
+    MessageType.EMOTES: 'emotes',
+    MessageType.EMOTES_DELTA: 'emotes',
+  }
+  CHAT = [MessageType.TEXT, MessageType.TEXT_BATCH]
+
+  def __init__(self, conn, size: int, policy: str, on_drop: Callable[[int], None]):
+    self.conn = conn
+    self.size = size
+    self.policy = policy
+    self.on_drop = on_drop
+    self.slots: Dict[str, PreparedMessage] = {}
+    self.control: Deque[PreparedMessage] = deque()
+    self.chat: Deque[PreparedMessage] = deque()
+    self.event = asyncio.Event()
+    self.closed = False
+    self.task: Task = asyncio.get_event_loop().create_task(self._writer_task())
+
+  def close(self):
+    self.closed = True
+    self.task.cancel()
+
+  def put(self, msg: PreparedMessage):
+    if self.closed:
+      return
+
+    if msg.type in self.LATEST_WINS:
+      slot = self.LATEST_WINS[msg.type]
+      if slot in self.slots and msg.full is not None:
+        # the pending update was never sent so the
+        # client can't apply a delta on top of it
+        msg = msg.full
+      self.slots[slot] = msg
+      self.event.set()
+      return
+
+    if len(self.control) + len(self.chat) >= self.size and not self._make_room(msg):
+      return
+    if msg.type in self.CHAT:
+      self.chat.append(msg)
+    else:
+      self.control.append(msg)
+    self.event.set()
+
+  # returns whether `msg` should still be queued
+  def _make_room(self, msg: PreparedMessage) -> bool:
+    if self.policy == OverflowPolicy.DISCONNECT:
+      self.on_drop(len(self.control) + len(self.chat) + 1)
+      self.control.clear()
+      self.chat.clear()
+      self.close()
+      self.conn.loop.create_task(self.conn.close(1008, 'slow consumer'))
+      return False
+    elif self.policy == OverflowPolicy.DROP_CHAT:
+      if len(self.chat) > 0:
+        self.chat.popleft()
+        self.on_drop(1)
+      elif msg.type in self.CHAT:
+        self.on_drop(1)
+        return False
+      # only system messages are queued so let it through
+      return True
+    else:
+      lane = self.chat if len(self.chat) > 0 else self.control
+      lane.popleft()
+      self.on_drop(1)
+      return True
+
+  # takes everything that is currently queued in priority order
+  def _take(self) -> List[PreparedMessage]:
+    batch = list(self.slots.values())
+    batch += self.control
+    batch += self.chat
+    self.slots.clear()
+    self.control.clear()
+    self.chat.clear()
+    return batch
+
+  async def _writer_task(self):
+    try:
+      while True:
+        await self.event.wait()
+        self.event.clear()
+        batch = self._take()
+        while len(batch) > 0:
+          await self.conn.write_prepared(batch)
+          batch = self._take()
+    except ConnectionClosed:
+      self.closed = True
@@ -0,0 +1,263 @@
+# Filters applied to chat messages before they are published
+from __future__ import annotations
+
+import asyncio
+import json
+import multiprocessing
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from typing import Any, Deque, Dict, List, Optional
+
+# processes for running offloaded stages with `PROCESS` set, shared by
+# every pipeline of the server. Without the pool they run in threads.
+PROCESSES = 2
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+class Stage:
+  """
+  A step of the pipeline that gets the text of a message and returns
+  the text to pass on, or nothing to drop the message.
+
+  Each stage has a time budget per message. While more than
+  `OFFLOAD_RATE` of the last `WINDOW` calls went over it the stage runs
+  in the executor so that it doesn't hold up the event loop, and it
+  goes back to running inline once that drops under half the rate. A
+  single slow call doesn't move it. Stages configured with `offload`
+  always run in the executor. CPU heavy stages set `PROCESS` to run in
+  a process pool instead of a thread, where the GIL doesn't hold up
+  the event loop either.
+  """
+  NAME = ''
+  BUDGET_MS = 1.0
+  PROCESS = False
+  # config keys of the stage besides the common ones
+  OPTIONS: List[str] = []
+  WINDOW = 100
+  # calls needed before the rate is trusted
+  MIN_CALLS = 20
+  OFFLOAD_RATE = 0.1
+
+  def __init__(self, budget_ms: float = None, offload: bool = False):
+    self.budget = (budget_ms if budget_ms is not None else self.BUDGET_MS) / 1000
+    self.always_offload = offload
+    self.offload = offload
+    self.recent: Deque[bool] = deque(maxlen=self.WINDOW)
+    self.recent_over = 0
+    # the config the stage was created from, to create
+    # it again in a process of the pool
+    self.config: Optional[str] = None
+    # metrics
+    self.calls = 0
+    self.dropped = 0
+    self.over_budget = 0
+    self.offloaded = 0
+    self.total_time = 0.0
+    self.max_time = 0.0
+
+  def apply(self, text: str) -> Optional[str]:
+    return text
+
+  async def run(self, text: str) -> Optional[str]:
+    if self.offload:
+      self.offloaded += 1
+      loop = asyncio.get_event_loop()
+      if self.PROCESS and self.config is not None and _process_pool is not None:
+        result, elapsed = await loop.run_in_executor(_process_pool, _apply_in_process, self.config, text)
+      else:
+        result, elapsed = await loop.run_in_executor(None, self._timed_apply, text)
+    else:
+      result, elapsed = self._timed_apply(text)
+
+    self.calls += 1
+    self.total_time += elapsed
+    self.max_time = max(self.max_time, elapsed)
+    over = elapsed > self.budget
+    if over:
+      self.over_budget += 1
+    self._update_offload(over)
+    if result is None:
+      self.dropped += 1
+    return result
+
+  def _update_offload(self, over: bool):
+    if len(self.recent) == self.WINDOW and self.recent[0]:
+      self.recent_over -= 1
+    self.recent.append(over)
+    self.recent_over += over
+    if self.always_offload or len(self.recent) < self.MIN_CALLS:
+      return
+    rate = self.recent_over / len(self.recent)
+    if rate > self.OFFLOAD_RATE:
+      self.offload = True
+    elif rate < self.OFFLOAD_RATE / 2:
+      self.offload = False
+
+  def metrics(self) -> dict:
+    return {
+      'calls': self.calls,
+      'dropped': self.dropped,
+      'over_budget': self.over_budget,
+      'offloaded': self.offloaded,
+      'offloading': self.offload,
+      'recent_over_rate': self.recent_over / max(len(self.recent), 1),
+      'avg_ms': self.total_time / max(self.calls, 1) * 1000,
+      'max_ms': self.max_time * 1000,
+    }
+
+  def _timed_apply(self, text: str):
+    start = perf_counter()
+    result = self.apply(text)
+    return result, perf_counter() - start
+
+
+class MaxLengthStage(Stage):
+  NAME = 'max_length'
+  BUDGET_MS = 0.1
+  OPTIONS = ['length', 'drop']
+
+  def __init__(self, length: int, drop: bool = False, **kwargs):
+    super().__init__(**kwargs)
+    self.length = length
+    self.drop = drop
+
+  def apply(self, text: str) -> Optional[str]:
+    if len(text) <= self.length:
+      return text
+    return None if self.drop else text[:self.length]
+
+
+class BannedWordsStage(Stage):
+  """
+  Masks or drops messages with any of the banned words. The words are
+  compiled into a single case-insensitive pattern so a message is
+  scanned once no matter how many words there are.
+  """
+  NAME = 'banned_words'
+  OPTIONS = ['words', 'drop']
+  PROCESS = True
+
+  def __init__(self, words: List[str], drop: bool = False, **kwargs):
+    super().__init__(**kwargs)
+    # longer words first so a word is not cut short by its prefix
+    words = sorted(set(words), key=len, reverse=True)
+    self.pattern = re.compile(r'(?<!\w)(?:' + '|'.join(map(re.escape, words)) + r')(?!\w)', re.IGNORECASE)
+    self.drop = drop
+
+  def apply(self, text: str) -> Optional[str]:
+    if self.drop:
+      return None if self.pattern.search(text) else text
+    return self.pattern.sub(lambda m: '*' * len(m.group()), text)
+
+
+class StripLinksStage(Stage):
+  NAME = 'strip_links'
+  OPTIONS = ['drop']
+  PATTERN = re.compile(r'\b(?:https?://|www\.)\S+', re.IGNORECASE)
+
+  def __init__(self, drop: bool = False, **kwargs):
+    super().__init__(**kwargs)
+    self.drop = drop
+
+  def apply(self, text: str) -> Optional[str]:
+    if self.drop:
+      return None if self.PATTERN.search(text) else text
+    text = self.PATTERN.sub('', text).strip()
+    # nothing is left of a message that was only a link
+    return text if len(text) > 0 else None
+
+
+STAGES = {stage.NAME: stage for stage in [MaxLengthStage, BannedWordsStage, StripLinksStage]}
+COMMON_OPTIONS = ['type', 'budget_ms', 'offload']
+
+
+def create_stage(config: Dict[str, Any]) -> Stage:
+  kwargs = {key: value for key, value in config.items() if key != 'type'}
+  stage = STAGES[config['type']](**kwargs)
+  stage.config = json.dumps(config, sort_keys=True)
+  return stage
+
+def start_process_pool():
+  """
+  Starts the process pool. The processes come from a fork server, a
+  fresh interpreter, so they don't inherit the sockets, event loop and
+  threads of the server the way forked processes would.
+  """
+  global _process_pool
+  if _process_pool is None:
+    _process_pool = ProcessPoolExecutor(PROCESSES, mp_context=multiprocessing.get_context('forkserver'))
+
+async def close_process_pool():
+  global _process_pool
+  if _process_pool is not None:
+    pool = _process_pool
+    _process_pool = None
+    await asyncio.get_event_loop().run_in_executor(None, pool.shutdown)
+
+# stages created in this process of the pool, by config
+_process_stages: Dict[str, Stage] = {}
+
+# runs in a process of the pool, the stage is only
+# created the first time its config is seen
+def _apply_in_process(config: str, text: str):
+  stage = _process_stages.get(config)
+  if stage is None:
+    stage = create_stage(json.loads(config))
+    _process_stages[config] = stage
+  return stage._timed_apply(text)
+
+
+def check_filters(obj: Any) -> List[Dict[str, Any]]:
+  """
+  Validates a filter config, a list of stages in the order they run:
+    [{"type": "max_length", "length": int, "drop"?: bool},
+     {"type": "banned_words", "words": List[str], "drop"?: bool},
+     {"type": "strip_links", "drop"?: bool}]
+  Every stage also takes "budget_ms" and "offload".
+  """
+  if not isinstance(obj, list):
+    raise Exception('invalid filters')
+  for config in obj:
+    if not isinstance(config, dict) or config.get('type') not in STAGES:
+      raise Exception('invalid filter type')
+    if any(key not in COMMON_OPTIONS + STAGES[config['type']].OPTIONS for key in config):
+      raise Exception('invalid filter option')
+    if not isinstance(config.get('drop', False), bool) or not isinstance(config.get('offload', False), bool):
+      raise Exception('invalid filter flags')
+    budget = config.get('budget_ms', 1)
+    if not isinstance(budget, (int, float)) or budget <= 0:
+      raise Exception('invalid filter budget_ms')
+    if config['type'] == MaxLengthStage.NAME:
+      if not isinstance(config.get('length'), int) or config['length'] <= 0:
+        raise Exception('invalid filter length')
+    elif config['type'] == BannedWordsStage.NAME:
+      words = config.get('words')
+      if not isinstance(words, list) or len(words) == 0 or not all(isinstance(w, str) and w for w in words):
+        raise Exception('invalid filter words')
+  return obj
+
+
+class Pipeline:
+  """
+  The filter stages of a stream, run in order on every chat message
+  between parsing and publishing.
+  """
+  def __init__(self, stages: List[Stage]):
+    self.stages = stages
+
+  @staticmethod
+  def create(filters: List[Dict[str, Any]]) -> Pipeline:
+    return Pipeline([create_stage(config) for config in filters])
+
+  async def run(self, text: str) -> Optional[str]:
+    for stage in self.stages:
+      text = await stage.run(text)
+      if text is None:
+        return None
+    return text
+
+  def metrics(self) -> List[dict]:
+    return [dict(stage.metrics(), type=stage.NAME) for stage in self.stages]
@@ -1,13 +1,19 @@
+from __future__ import annotations
 import asyncio
+import email.utils
 from http import HTTPStatus
 import re
 import functools
+from urllib.parse import parse_qsl
 from websockets.datastructures import Headers
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from websockets.frames import OP_TEXT
 from websockets.legacy.http import d, read_line, read_headers
 from websockets.legacy.server import HTTPResponse, WebSocketServerProtocol
-from websockets.exceptions import AbortHandshake
+from jc.server.broadcast import PreparedMessage
+from jc.server.message import CODECS, JSON, Codec
 
-from typing import Callable, Coroutine, Dict, List, Optional, Tuple
+from typing import BinaryIO, Callable, Coroutine, Dict, List, Optional, Tuple
 
 def add_default_headers(resp: HTTPResponse, new_headers: Dict[str, str]) -> HTTPResponse:
   headers = resp[1] or {}
@@ -16,7 +22,7 @@ def add_default_headers(resp: HTTPResponse, new_headers: Dict[str, str]) -> HTTP
       headers[key] = value
   return (resp[0], headers, resp[2])
 
-async def read_request(stream: asyncio.StreamReader) -> Tuple[str, Headers]:
+async def read_request(stream: asyncio.StreamReader) -> Tuple[str, str, Dict[str, str], Headers, bytes]:
   try:
     request_line = await read_line(stream)
   except EOFError as exc:
@@ -42,23 +48,113 @@ async def read_request(stream: asyncio.StreamReader) -> Tuple[str, Headers]:
     except Exception as exc:
       raise exc
 
-  return method.decode("utf-8"), path.rstrip('/'), headers, body
+  path, _, query = path.partition('?')
+  return method.decode("utf-8"), path.rstrip('/'), dict(parse_qsl(query)), headers, body
 
 
-class NoMatchError(Exception):
-  pass
+class RouteNode:
+  def __init__(self):
+    self.children: Dict[str, RouteNode] = {}
+    # child for a `{param}` segment
+    self.param: Optional[Tuple[str, RouteNode]] = None
+    self.handlers: Dict[str, Optional[Coroutine]] = {}
+
+class Router:
+  """
+  Routes compiled into a trie of path segments, built once and shared
+  by every connection. A lookup walks the path segments once, static
+  segments are tried before parameters. A `('*', '*', fn)` route is
+  used when nothing else matches.
+  """
+  PARAM = re.compile(r'\{([a-zA-Z_]+)\}')
+  PARAM_VALUE = re.compile(r'\w+')
+
+  def __init__(self, routes: List[Tuple[str, str, Coroutine]]):
+    self.root = RouteNode()
+    self.fallback: Optional[Coroutine] = None
+    self.allowed_methods = set([r[0] for r in routes if r[0] != '*'])
+    for method, route, fn in routes:
+      if route == '*':
+        self.fallback = fn
+      else:
+        self._add(method, route, fn)
+
+  def _add(self, method: str, route: str, fn: Optional[Coroutine]):
+    node = self.root
+    param_names = []
+    for segment in self._segments(route.strip()):
+      match = self.PARAM.fullmatch(segment)
+      if match is None:
+        node = node.children.setdefault(segment, RouteNode())
+        continue
+
+      name = match.group(1)
+      if name in param_names:
+        raise Exception(f'duplicate route paramter "{name}"')
+      param_names += [name]
+      if node.param is None:
+        node.param = (name, RouteNode())
+      elif node.param[0] != name:
+        raise Exception(f'conflicting route parameters "{node.param[0]}" and "{name}"')
+      node = node.param[1]
+    node.handlers[method] = fn
+
+  def match(self, method: str, path: str) -> Optional[Tuple[Optional[Coroutine], Dict[str, str]]]:
+    """
+    Returns the handler for a request and the path parameters, or nothing
+    if no route matches. The handler is None for websocket routes.
+    """
+    params = {}
+    node = self._match(self.root, self._segments(path), 0, params)
+    if node is not None:
+      if method in node.handlers:
+        return node.handlers[method], params
+      if '*' in node.handlers:
+        return node.handlers['*'], params
+    if self.fallback is not None:
+      return self.fallback, {}
+    return None
+
+  def _match(self, node: RouteNode, segments: List[str], i: int, params: Dict[str, str]) -> Optional[RouteNode]:
+    if i == len(segments):
+      return node if len(node.handlers) > 0 else None
+
+    child = node.children.get(segments[i])
+    if child is not None:
+      found = self._match(child, segments, i + 1, params)
+      if found is not None:
+        return found
+    if node.param is not None and self.PARAM_VALUE.fullmatch(segments[i]):
+      name, child = node.param
+      found = self._match(child, segments, i + 1, params)
+      if found is not None:
+        params[name] = segments[i]
+        return found
+    return None
 
-class NotHandledError(Exception):
+  @staticmethod
+  def _segments(path: str) -> List[str]:
+    path = path.strip('/')
+    return path.split('/') if path else []
+
+class ConnectionDoneError(ConnectionError):
+  """
+  Ends a connection that was only used for http requests, websockets
+  then closes the transport without writing anything else.
+  """
   pass
 
 class WebsocketProtocol(WebSocketServerProtocol):
-  def __init__(self, routes: List[Tuple[str, str, Coroutine]], handle_request=None, *args, **kwargs):
+  # how long an idle http connection is kept open
+  KEEP_ALIVE_TIMEOUT = 30
+
+  def __init__(self, router: Router, handle_request=None, *args, **kwargs):
     super().__init__(*args, **kwargs)
-    self.handlers = self._parse_routes(routes)
-    self.allowed_methods = set([r[0] for r in routes if r[0] != '*'])
+    self.router = router
     self.handle_request = handle_request
     self.method = ''
     self.path = ''
+    self.query = {}
     self.headers = {}
     self.params = {}
 
@@ -68,100 +164,160 @@ class WebsocketProtocol(WebSocketServerProtocol):
     `routes` is a list of tuples containing the method, followed by the url
     pattern, followed by the handler.
     """
-    return functools.partial(WebsocketProtocol, routes, handle_request)
+    return functools.partial(WebsocketProtocol, Router(routes), handle_request)
 
   async def read_http_request(self) -> Tuple[str, Headers]:
     return self.path, self.headers
 
   # handle routing before websocket handshake
   async def handshake(self, *args, **kwargs) -> str:
-    method, path, headers, body = await read_request(self.reader)
-    if method == 'OPTIONS':
-      resp = self.handle_options_request(path, headers, body)
-      raise AbortHandshake(*resp)
-
-    # print(f'{method} {path}')
-    for handler in self.handlers:
+    """
+    Answers http requests until one asks to upgrade to a websocket.
+    Connections are kept alive unless the client asks otherwise and
+    pipelined requests are read and answered one after the other so
+    the responses are in order.
+    """
+    timeout = None
+    while True:
       try:
-        resp = await handler(method, path, headers, body)
-        resp = add_default_headers(resp, {
-          'Access-Control-Allow-Origin': '*',
-        })
-        raise AbortHandshake(*resp)
-      except NoMatchError:
-        continue
-      except NotHandledError:
-        break
-    
+        request = await asyncio.wait_for(read_request(self.reader), timeout)
+      except (EOFError, asyncio.TimeoutError):
+        raise ConnectionDoneError()
+      method, path, query, headers, body = request
+      timeout = self.KEEP_ALIVE_TIMEOUT
+
+      # print(f'{method} {path}')
+      if method == 'OPTIONS':
+        resp = self.handle_options_request(path, headers, body)
+      else:
+        route = self.router.match(method, path)
+        if route is None or route[0] is None:
+          if method == 'GET' and 'websocket' in headers.get('Upgrade', '').lower():
+            break
+          resp = (HTTPStatus.UPGRADE_REQUIRED, {'Upgrade': 'websocket'}, bytes())
+        else:
+          fn, params = route
+          req = {
+            'method': method,
+            'path': path,
+            'query': query,
+            'headers': headers,
+            'body': body
+          }
+          resp = await fn(req, params)
+
+      resp = add_default_headers(resp, {
+        'Access-Control-Allow-Origin': '*',
+      })
+      if callable(resp[2]):
+        await self.write_streamed_response(*resp)
+        raise ConnectionDoneError()
+
+      # without a content length the end of a request body is unknown
+      keep_alive = headers.get('Connection', '').lower() != 'close' and 'Transfer-Encoding' not in headers
+      await self.write_response(*resp, keep_alive)
+      if not keep_alive:
+        raise ConnectionDoneError()
+
     self.method = method
     self.path = path
+    self.query = query
     self.headers = headers
+    self.params = route[1] if route is not None else {}
     return await super().handshake(*args, **kwargs)
 
+  # the message encoding negotiated during the handshake
+  @property
+  def codec(self) -> Codec:
+    return CODECS.get(self.subprotocol, JSON)
+
   async def process_request(self, path: str, request_headers: Headers) -> Optional[HTTPResponse]:
     if self.handle_request:
       return await self.handle_request(self)
     return None
 
+  # the server window size when permessage-deflate was negotiated
+  # without context takeover, the only extension that allows sharing
+  # compressed frames between connections
+  @property
+  def deflate_bits(self) -> Optional[int]:
+    if len(self.extensions) != 1:
+      return None
+    ext = self.extensions[0]
+    if isinstance(ext, PerMessageDeflate) and ext.local_no_context_takeover:
+      return ext.local_max_window_bits
+    return None
+
+  async def write_prepared(self, msgs: List[PreparedMessage]):
+    """
+    Writes a batch of prepared messages and waits for the transport to
+    drain once. The pre-built frames are valid without extensions or
+    with permessage-deflate without context takeover, otherwise the
+    messages go through the regular send.
+    """
+    await self.ensure_open()
+    codec = self.codec
+    deflate_bits = self.deflate_bits
+    if self.extensions and deflate_bits is None:
+      for msg in msgs:
+        data = msg.payload(codec)
+        await self.send(data.decode('utf-8') if codec.opcode == OP_TEXT else data)
+      return
+
+    for msg in msgs:
+      self.transport.write(msg.frame(codec, deflate_bits))
+    try:
+      async with self._drain_lock:
+        await self._drain()
+    except ConnectionError:
+      self.fail_connection()
+      await self.ensure_open()
+
+  async def write_response(self, status: HTTPStatus, headers: Dict[str, str], body: bytes, keep_alive: bool):
+    headers = Headers(headers)
+    headers.setdefault('Date', email.utils.formatdate(usegmt=True))
+    headers['Content-Length'] = str(len(body))
+    headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    self.write_http_response(status, headers, body)
+    await self._drain()
+
+  async def write_streamed_response(self, status: HTTPStatus, headers: Dict[str, str],
+                                    body: Callable[[WebsocketProtocol], Coroutine]):
+    """
+    Writes a response with a chunked body. `body` is called with this
+    protocol and writes the chunks with `write_chunk` and `send_file`.
+    """
+    headers = Headers(headers)
+    headers['Transfer-Encoding'] = 'chunked'
+    headers['Connection'] = 'close'
+    self.write_http_response(status, headers)
+    await body(self)
+    self.transport.write(b'0\r\n\r\n')
+    await self._drain()
+
+  async def write_chunk(self, data: bytes):
+    if len(data) == 0:
+      return
+    self.transport.write(b'%x\r\n' % len(data) + data + b'\r\n')
+    await self._drain()
+
+  async def send_file(self, file: BinaryIO, offset: int, count: int):
+    """
+    Writes a byte range of a file as a single chunk, with sendfile when
+    the transport supports it (not with tls) and by copying otherwise.
+    """
+    if count == 0:
+      return
+    if self.transport.is_closing():
+      # the client went away during the download
+      raise ConnectionResetError()
+    self.transport.write(b'%x\r\n' % count)
+    await self.loop.sendfile(self.transport, file, offset, count)
+    self.transport.write(b'\r\n')
+
   def handle_options_request(self, path, headers, body) -> HTTPResponse:
     resp_headers = {
-      'Access-Control-Allow-Methods': ', '.join(self.allowed_methods),
+      'Access-Control-Allow-Methods': ', '.join(self.router.allowed_methods),
       'Access-Control-Allow-Origin': '*',
     }
     return (HTTPStatus(204), resp_headers, bytes())
-
-  #
-
-  def _parse_routes(self, routes: List[Tuple[str, str, Coroutine]]) -> Tuple[List[Coroutine], Coroutine]:
-    # we're not really validating the routes so
-    # just write them properly :p
-    route_handlers = []
-    for group in routes:
-      method, route, fn = group
-
-      param_names = []
-      route = route.strip().rstrip('/').replace('/', '\/')
-      for match in re.finditer(r'(?<=\{)([a-zA-Z_]+)(?=\})', route):
-        param_name = match.group()
-        if param_name in param_names:
-          raise Exception(f'duplicate route paramter "{param_name}"')
-        param_names += [param_name]
-
-      # build regex using named capture groups
-      for param in param_names:
-        route = route.replace(f'{{{param}}}', f'(?P<{param}>\w+)')
-      
-      def capture(fn, method, route, param_names):
-        if route == '*':
-          assert len(param_names) == 0
-          regex = None
-        else:
-          regex = re.compile(route)
-
-        async def handler(mthd, path, headers, body):
-          if regex is not None:
-            match = regex.fullmatch(path)
-            if match is None:
-              raise NoMatchError()
-          if method != mthd and method != '*':
-            raise NoMatchError()
-          
-          req = {
-            'method': mthd,
-            'path': path,
-            'headers': headers,
-            'body': body
-          }
-
-          params = {}
-          for param in param_names:
-            params[param] = match.group(param)
-
-          self.params = params
-          if fn is None:
-            raise NotHandledError()
-          return await fn(req, params)
-        return handler
-    
-      route_handlers += [capture(fn, method, route, param_names)]
-    return route_handlers
@@ -0,0 +1,46 @@
+# Token buckets for limiting how fast chat messages come in
+from time import monotonic
+
+
+class RateLimitPolicy:
+  DROP = 'drop'             # only drop messages over the limit
+  SLOW_MODE = 'slow_mode'   # also lower the user's rate after repeated offenses
+  DISCONNECT = 'disconnect' # also close the connection after repeated offenses
+
+  ALL = [DROP, SLOW_MODE, DISCONNECT]
+
+
+class TokenBucket:
+  """
+  Allows `rate` messages per second on average and bursts of up to
+  `burst` messages. Tokens are refilled lazily when one is taken so
+  a bucket is just a few numbers and `take` is O(1).
+  """
+  def __init__(self, rate: float, burst: int):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = float(burst)
+    self.updated = monotonic()
+
+  def take(self) -> bool:
+    now = monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    if self.tokens < 1:
+      return False
+    self.tokens -= 1
+    return True
+
+
+class PeerLimit:
+  """
+  The escalation state of a peer address in a stream. Buckets belong
+  to connections, but this is kept by the stream so that reconnecting
+  or picking another name doesn't clear the strikes and slow mode.
+  """
+  def __init__(self):
+    # messages rejected in a row
+    self.strikes = 0
+    self.slow_mode = False
+    # closed for rate limiting before, closed again on the next offense
+    self.disconnected = False
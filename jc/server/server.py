@@ -5,34 +5,150 @@ import functools
 
 from jc.db.emotes import BTTV_EMOTES
 import json
+import os
+import re
 import websockets
+from time import monotonic
 from http import HTTPStatus
 from ssl import SSLContext
 from websockets.legacy.server import HTTPResponse
 from websockets.exceptions import ConnectionClosed
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 
 from jc.db import db
 from jc.server import message
+from jc.server.broadcast import PreparedMessage
+from jc.server.bus import MessageBus, create_bus
+from jc.server.export import export_body
+from jc.server.logstore import LogReader, store_path
 from jc.server.organization import Organization
+from jc.server.outbox import OverflowPolicy
+from jc.server.pipeline import Pipeline, check_filters, close_process_pool, start_process_pool
+from jc.server.ratelimit import RateLimitPolicy
 from jc.server.stream import Stream
 from jc.server.protocol import WebsocketProtocol
+from jc.server.session import Session
 from jc.server.user import User
 
-from typing import Any, Dict
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
 
 def _w(self, fn):
   return functools.partial(fn, self)
 
+# ids in bulk requests, the same as the route parameters
+ID_PATTERN = re.compile(r'\w+')
+
+# parses the optional json body of a stream setup request
+def parse_stream_options(body: bytes) -> Dict[str, Any]:
+  if not body:
+    return {}
+  return check_stream_options(json.loads(body.decode('utf-8')))
+
+def check_stream_options(obj: Any) -> Dict[str, Any]:
+  options = {}
+  if not isinstance(obj, dict):
+    raise Exception('invalid stream options')
+  if 'outbox_size' in obj:
+    if not isinstance(obj['outbox_size'], int) or obj['outbox_size'] <= 0:
+      raise Exception('invalid outbox_size')
+    options['outbox_size'] = obj['outbox_size']
+  if 'outbox_policy' in obj:
+    if obj['outbox_policy'] not in OverflowPolicy.ALL:
+      raise Exception('invalid outbox_policy')
+    options['outbox_policy'] = obj['outbox_policy']
+  if 'batch_interval' in obj:
+    # in milliseconds, keep the added latency bounded
+    if not isinstance(obj['batch_interval'], int) or not 0 <= obj['batch_interval'] <= 1000:
+      raise Exception('invalid batch_interval')
+    options['batch_interval'] = obj['batch_interval']
+  if 'filters' in obj:
+    options['filters'] = check_filters(obj['filters'])
+  # messages per second and burst sizes of the rate limits
+  for key in ['user_rate', 'stream_rate']:
+    if key in obj:
+      if not isinstance(obj[key], (int, float)) or isinstance(obj[key], bool) or obj[key] <= 0:
+        raise Exception(f'invalid {key}')
+      options[key] = obj[key]
+  for key in ['user_burst', 'stream_burst']:
+    if key in obj:
+      if not isinstance(obj[key], int) or isinstance(obj[key], bool) or obj[key] <= 0:
+        raise Exception(f'invalid {key}')
+      options[key] = obj[key]
+  if 'rate_limit_policy' in obj:
+    if obj['rate_limit_policy'] not in RateLimitPolicy.ALL:
+      raise Exception('invalid rate_limit_policy')
+    options['rate_limit_policy'] = obj['rate_limit_policy']
+  return options
+
+# parses an emote list or a default set name into emotes
+def parse_emotes(obj: Any) -> List[Tuple[str, str]]:
+  new_emotes = []
+  if isinstance(obj, list):
+    for o in obj:
+      if 'name' not in o or not isinstance(o['name'], str):
+        raise Exception('invalid emote name')
+      elif 'url' not in o or not isinstance(o['url'], str):
+        raise Exception('invalid emote url')
+      new_emotes += [(o['name'], o['url'])]
+  elif isinstance(obj, dict):
+    if obj.get('default_set') == 'bttv':
+      new_emotes = BTTV_EMOTES
+    else:
+      raise Exception('invalid default set')
+  else:
+    raise Exception('invalid emotes')
+  return new_emotes
+
+# parses the json list of ids of a bulk request
+def parse_id_list(body: bytes) -> List[str]:
+  ids = json.loads(body.decode('utf-8'))
+  if not isinstance(ids, list) or not all(isinstance(id, str) and ID_PATTERN.fullmatch(id) for id in ids):
+    raise Exception('invalid id list')
+  return ids
+
+def bulk_response(results: List[Dict[str, Any]]) -> HTTPResponse:
+  body = json.dumps({'results': results}).encode('utf-8')
+  return (HTTPStatus(200), {'Content-Type': 'application/json'}, body)
+
+# parses the time range of a log query, times are in ms since the epoch
+def parse_time_range(query: Dict[str, str]) -> Tuple[int, int]:
+  since = int(query.get('since', 0))
+  until = int(query.get('until', 2 ** 62))
+  if since < 0 or until < since:
+    raise Exception('invalid time range')
+  return since, until
+
+def parse_history_query(query: Dict[str, str]) -> Tuple[int, int, int]:
+  since, until = parse_time_range(query)
+  limit = int(query.get('limit', Server.HISTORY_LIMIT))
+  if not 0 < limit <= Server.HISTORY_MAX_LIMIT:
+    raise Exception('invalid history limit')
+  return since, until, limit
+
 class Server:
   UPDATE_TIMEOUT = 5
+  # how often an unchanged viewer count is sent to the other nodes
+  VIEWERS_REFRESH = 30
+  HISTORY_LIMIT = 100
+  HISTORY_MAX_LIMIT = 1000
+  # readers of stream logs kept open between queries
+  LOG_READERS = 16
 
-  def __init__(self, host: str, port: int, ssl: SSLContext = None):
+  def __init__(self, host: str, port: int, ssl: SSLContext = None,
+               bus: MessageBus = None, reuse_port: bool = False, compression: bool = True):
     self.host = host
     self.port = port
     self.ssl = ssl
+    # connects this node to the other worker processes and machines
+    self.bus = bus or create_bus()
+    self.reuse_port = reuse_port
+    # permessage-deflate for clients that support it
+    self.compression = compression
     self.conn_event = asyncio.Event()
     self.orgs: Dict[str, Organization] = {}
     self.streams: Dict[str, Stream] = {}
+    self.log_readers: OrderedDict = OrderedDict()
 
   def serve(self) -> Any:
     def handle_conn_wrapper(ws, path):
@@ -44,7 +160,16 @@ class Server:
         ('DELETE', '/org/{org_id}', _w(self, Server.handle_org_teardown)),
         ('PUT', '/org/{org_id}/emotes', _w(self, Server.handle_update_emotes)),
         ('PUT', '/org/{org_id}/streams/{stream_id}', _w(self, Server.handle_stream_setup)),
+        ('POST', '/orgs', _w(self, Server.handle_bulk_org_setup)),
+        ('DELETE', '/orgs', _w(self, Server.handle_bulk_org_teardown)),
+        ('PUT', '/orgs/emotes', _w(self, Server.handle_bulk_update_emotes)),
+        ('PUT', '/streams', _w(self, Server.handle_bulk_stream_setup)),
+        ('DELETE', '/streams', _w(self, Server.handle_bulk_stream_teardown)),
         ('GET', '/stream/{stream_id}', None),
+        ('GET', '/stream/{stream_id}/stats', _w(self, Server.handle_stream_stats)),
+        ('GET', '/stream/{stream_id}/history', _w(self, Server.handle_stream_history)),
+        ('GET', '/stream/{stream_id}/export', _w(self, Server.handle_stream_export)),
+        ('PUT', '/stream/{stream_id}/filters', _w(self, Server.handle_update_filters)),
         ('DELETE', '/stream/{stream_id}', _w(self, Server.handle_stream_teardown)),
         ('*', '*', _w(self, Server.handle_unknown))
       ],
@@ -52,6 +177,10 @@ class Server:
     )
 
     asyncio.get_event_loop().run_until_complete(db.create_tables())
+    asyncio.get_event_loop().run_until_complete(db.init_pool())
+    asyncio.get_event_loop().run_until_complete(self.bus.connect(self.handle_bus_event))
+    # before any connection is accepted
+    start_process_pool()
 
     print(f'starting server on port {self.port}')
     return websockets.serve(
@@ -59,13 +188,188 @@ class Server:
       self.host, 
       self.port,
       ssl=self.ssl, 
-      create_protocol=protocol_factory
+      create_protocol=protocol_factory,
+      subprotocols=message.SUBPROTOCOLS,
+      # broadcasts are written as prepared frames, they can only be
+      # compressed once for everyone without context takeover
+      compression=None,
+      extensions=[
+        ServerPerMessageDeflateFactory(
+          server_no_context_takeover=True,
+          client_no_context_takeover=True,
+        )
+      ] if self.compression else None,
+      # workers all listen on the same port
+      reuse_port=self.reuse_port
     )
 
+  async def close(self):
+    await self.bus.close()
+    await db.close_pool()
+    await close_process_pool()
+
+  # publishes a message to the stream on every node
   async def publish(self, stream: Stream, message: object):
     if stream is None:
       return
-    await asyncio.wait([user.send(message) for user in stream.users])
+    # the local users get the message right away, the other nodes
+    # number it the same as this one unless they're already past it
+    prepared = stream.prepare(message)
+    stream.broadcast(prepared)
+    self.bus.send({
+      'op': 'publish',
+      'stream_id': stream.id,
+      'message': message,
+      'seq': prepared.obj.get('seq')
+    })
+
+  # publishes a message to the users connected to this node
+  async def publish_local(self, stream: Stream, message: object, seq: int = None):
+    if not isinstance(message, PreparedMessage):
+      message = stream.prepare(message, seq)
+    stream.broadcast(message)
+
+  # org and stream state changes, these are applied locally and
+  # then sent to the other nodes through the bus
+
+  async def setup_org(self, org_id: str, emotes: List[Tuple[str, str]] = None) -> Organization:
+    print(f'setting up org {org_id}')
+    org = await Organization.create(org_id, emotes)
+    self.orgs[org_id] = org
+    return org
+
+  # closes the org and all of its streams right away, they're only
+  # removed once closed so a teardown that failed can be retried
+  async def teardown_org(self, org_id: str):
+    print(f'tearing down org {org_id}')
+    org = self.orgs[org_id]
+    streams = list(org.streams)
+    for stream in streams:
+      stream.deleted = True
+    await org.close()
+    if self.orgs.get(org_id) is org:
+      del self.orgs[org_id]
+    for stream in streams:
+      if self.streams.get(stream.id) is stream:
+        del self.streams[stream.id]
+
+  async def set_emotes(self, org_id: str, emotes: List[Tuple[str, str]],
+                       added: List[Tuple[str, str]] = None, removed: List[str] = None):
+    org = self.orgs[org_id]
+    base = org.emotes_version
+    org.set_emotes(emotes, added, removed)
+    if org.emotes_version == base:
+      return
+
+    # connected clients have the previous set
+    update = org.emotes_update(base)
+    for stream in org.streams:
+      await self.publish_local(stream, update)
+
+  async def setup_stream(self, org_id: str, stream_id: str, options: Dict[str, Any]) -> Stream:
+    org = self.orgs[org_id]
+    print(f'setting up stream {stream_id}')
+    stream = await Stream.create(stream_id, org, **options)
+    stream.add_task(_w(self, Server.update_viewer_count))
+    stream.add_task(_w(self, Server.close_deleted_stream))
+    
+    self.streams[stream_id] = stream
+    org.add_stream(stream)
+    return stream
+
+  def teardown_stream(self, stream_id: str):
+    print(f'tearing down stream {stream_id}')
+    stream = self.streams[stream_id]
+    stream.deleted = True
+
+  # sets up the orgs that don't exist yet with their emotes loaded
+  # in a single query, returns the ids of the new orgs
+  async def setup_orgs(self, org_ids: List[str]) -> List[str]:
+    new_ids = [org_id for org_id in dict.fromkeys(org_ids) if org_id not in self.orgs]
+    emotes = await db.get_emotes_bulk(new_ids)
+    await asyncio.gather(*[self.setup_org(org_id, emotes[org_id]) for org_id in new_ids])
+    return new_ids
+
+  # applies a saved emote set and sends it to the other nodes
+  async def update_emotes(self, org_id: str, emotes: List[Tuple[str, str]],
+                          added: List[Tuple[str, str]], removed: List[str]):
+    base = self.orgs[org_id].emotes_version
+    await self.set_emotes(org_id, emotes, added, removed)
+    self.bus.send({
+      'op': 'emotes',
+      'org_id': org_id,
+      'base': base,
+      'emotes': emotes,
+      'added': added,
+      'removed': removed,
+      'retain': f'emotes:{org_id}'
+    })
+
+  def send_org_setup(self, org: Organization):
+    self.bus.send({
+      'op': 'org_setup',
+      'org_id': org.id,
+      'emotes': org.emotes,
+      'retain': f'org:{org.id}'
+    })
+
+  def send_stream_setup(self, org: Organization, stream_id: str, options: Dict[str, Any]):
+    self.bus.send({
+      'op': 'stream_setup',
+      'org_id': org.id,
+      'stream_id': stream_id,
+      'options': options,
+      'emotes': org.emotes,
+      'retain': f'stream:{stream_id}'
+    })
+
+  # handles events from the other nodes
+  async def handle_bus_event(self, event: dict):
+    op = event['op']
+    if op == 'publish':
+      stream = self.streams.get(event['stream_id'])
+      if stream is not None:
+        await self.publish_local(stream, event['message'], event['seq'])
+    elif op == 'viewers':
+      stream = self.streams.get(event['stream_id'])
+      if stream is not None:
+        stream.set_remote_viewers(event['node'], event['count'])
+    elif op == 'session':
+      stream = self.streams.get(event['stream_id'])
+      if stream is not None:
+        stream.sessions.save(event['token'], Session.from_dict(event['session']))
+    elif op == 'session_taken':
+      stream = self.streams.get(event['stream_id'])
+      if stream is not None:
+        stream.sessions.take(event['token'])
+    elif op == 'node_lost':
+      for stream in self.streams.values():
+        stream.remote_viewers.pop(event['node'], None)
+    elif op == 'org_setup':
+      if event['org_id'] not in self.orgs:
+        await self.setup_org(event['org_id'], event['emotes'])
+    elif op == 'org_teardown':
+      if event['org_id'] in self.orgs:
+        await self.teardown_org(event['org_id'])
+    elif op == 'emotes':
+      org = self.orgs.get(event['org_id'])
+      if org is not None and org.emotes_version == event['base']:
+        await self.set_emotes(org.id, event['emotes'], event['added'], event['removed'])
+      elif org is not None:
+        # the diff doesn't apply to the set this node has
+        await self.set_emotes(org.id, event['emotes'])
+    elif op == 'stream_setup':
+      if event['org_id'] not in self.orgs:
+        await self.setup_org(event['org_id'], event['emotes'])
+      if event['stream_id'] not in self.streams:
+        await self.setup_stream(event['org_id'], event['stream_id'], event['options'])
+    elif op == 'filters':
+      stream = self.streams.get(event['stream_id'])
+      if stream is not None:
+        stream.pipeline = Pipeline.create(event['filters'])
+    elif op == 'stream_teardown':
+      if event['stream_id'] in self.streams:
+        self.teardown_stream(event['stream_id'])
 
   #
 
@@ -79,9 +383,8 @@ class Server:
     if org_id in self.orgs:
       return (HTTPStatus(304), {}, bytes())
     
-    print(f'setting up org {org_id}')
-    org = await Organization.create(org_id)
-    self.orgs[org_id] = org
+    org = await self.setup_org(org_id)
+    self.send_org_setup(org)
     return (HTTPStatus(201), {}, bytes())
 
   # DELETE /org/{org_id}
@@ -90,9 +393,8 @@ class Server:
     if org_id not in self.orgs:
       return (HTTPStatus(404), {}, bytes())
 
-    org = self.orgs[org_id]
-    print(f'tearing down org {org_id}')
-    await org.close()
+    await self.teardown_org(org_id)
+    self.bus.send({'op': 'org_teardown', 'org_id': org_id, 'retain': f'org:{org_id}'})
     await db.delete_emotes(org_id)
     return (HTTPStatus(200), {}, bytes())
     
@@ -101,27 +403,9 @@ class Server:
     org_id = params['org_id']
     if org_id not in self.orgs:
       return (HTTPStatus(404), {}, bytes())
-    org = self.orgs[org_id]
 
-    new_emotes = []
     try:
-      obj = json.loads(req['body'].decode('utf-8'))
-      if isinstance(obj, list):
-        for o in obj:
-          if 'name' not in o or not isinstance(o['name'], str):
-            raise Exception()
-          elif 'url' not in o or not isinstance(o['url'], str):
-            raise Exception()
-          new_emotes += [(o['name'], o['url'])]
-      elif isinstance(obj, object):
-        if not 'default_set' in obj:
-          raise Exception()
-        if obj['default_set'] == 'bttv':
-            new_emotes = BTTV_EMOTES
-        else:
-          raise Exception()
-      else:
-        raise Exception()
+      new_emotes = parse_emotes(json.loads(req['body'].decode('utf-8')))
     except Exception as e:
       print(e)
       return (HTTPStatus(400), {}, bytes())
@@ -130,12 +414,11 @@ class Server:
       if len(new_emotes) == 0:
         return (HTTPStatus(204), {}, bytes())
 
-      emotes = await db.save_emotes(org_id, new_emotes)
-      org.emotes = emotes
+      emotes, added, removed = await db.save_emotes(org_id, new_emotes)
+      if len(added) == 0 and len(removed) == 0:
+        return (HTTPStatus(200), {}, bytes())
 
-      msg = message.emotes_message(emotes)
-      if len(org.streams) > 0:
-        await asyncio.wait([self.publish(s, msg) for s in org.streams])
+      await self.update_emotes(org_id, emotes, added, removed)
     except Exception:
       return (HTTPStatus(500), {}, bytes())
     return (HTTPStatus(200), {}, bytes())
@@ -147,20 +430,19 @@ class Server:
     if org_id in self.orgs:
       org = self.orgs[org_id]
     else:
-      print(f'setting up org {org_id}')
-      org = await Organization.create(org_id)
-      self.orgs[org_id] = org
+      org = await self.setup_org(org_id)
     
     if stream_id in self.streams:
       return (HTTPStatus(304), {}, bytes())
+
+    try:
+      options = parse_stream_options(req['body'])
+    except Exception as e:
+      print(e)
+      return (HTTPStatus(400), {}, bytes())
     
-    print(f'setting up stream {stream_id}')
-    stream = await Stream.create(stream_id, org)
-    stream.add_task(_w(self, Server.update_viewer_count))
-    stream.add_task(_w(self, Server.close_deleted_stream))
-    
-    self.streams[stream_id] = stream
-    org.add_stream(stream)
+    await self.setup_stream(org_id, stream_id, options)
+    self.send_stream_setup(org, stream_id, options)
     return (HTTPStatus(201), {}, bytes())
 
   # DELETE /stream/{stream_id}
@@ -169,11 +451,253 @@ class Server:
     if stream_id not in self.streams:
       return (HTTPStatus(404), {}, bytes())
     
-    print(f'tearing down stream {stream_id}')
-    stream = self.streams[stream_id]
-    stream.deleted = True
+    self.teardown_stream(stream_id)
+    self.bus.send({'op': 'stream_teardown', 'stream_id': stream_id, 'retain': f'stream:{stream_id}'})
     return (HTTPStatus(200), {}, bytes())
 
+  # bulk routes, these take a json list of items and respond with
+  # a list of {<ids>, status} results in the same order
+
+  # POST /orgs ["<org_id>", ...]
+  async def handle_bulk_org_setup(self, req: object, params: Dict[str, str]) -> HTTPResponse:
+    try:
+      org_ids = parse_id_list(req['body'])
+    except Exception as e:
+      print(e)
+      return (HTTPStatus(400), {}, bytes())
+
+    created = await self.setup_orgs(org_ids)
+    for org_id in created:
+      self.send_org_setup(self.orgs[org_id])
+    return bulk_response([
+      {'org_id': org_id, 'status': 201 if org_id in created else 304} for org_id in org_ids
+    ])
+
+  # DELETE /orgs ["<org_id>", ...]
+  async def handle_bulk_org_teardown(self, req: object, params: Dict[str, str]) -> HTTPResponse:
+    try:
+      org_ids = parse_id_list(req['body'])
+    except Exception as e:
+      print(e)
+      return (HTTPStatus(400), {}, bytes())
+
+    found = [org_id for org_id in dict.fromkeys(org_ids) if org_id in self.orgs]
+    results = await asyncio.gather(*[self.teardown_org(org_id) for org_id in found], return_exceptions=True)
+    statuses = {}
+    for org_id, result in zip(found, results):
+      if isinstance(result, Exception):
+        print(f'failed to tear down org {org_id}: {result}')
+        statuses[org_id] = 500
+      else:
+        statuses[org_id] = 200
+        self.bus.send({'op': 'org_teardown', 'org_id': org_id, 'retain': f'org:{org_id}'})
+
+    # the emotes of all orgs are deleted in one query, or one
+    # org at a time to find out which ones failed
+    deleted = [org_id for org_id in found if statuses[org_id] == 200]
+    try:
+      await db.delete_emotes_bulk(deleted)
+    except Exception:
+      results = await asyncio.gather(*[db.delete_emotes(org_id) for org_id in deleted], return_exceptions=True)
+      for org_id, result in zip(deleted, results):
+        if isinstance(result, Exception):
+          statuses[org_id] = 500
+    return bulk_response([{'org_id': org_id, 'status': statuses.get(org_id, 404)} for org_id in org_ids])
+
+  # PUT /orgs/emotes {"<org_id>": <emotes>, ...}
+  async def handle_bulk_update_emotes(self, req: object, params: Dict[str, str]) -> HTTPResponse:
+    try:
+      obj = json.loads(req['body'].decode('utf-8'))
+      if not isinstance(obj, dict):
+        raise Exception('invalid emote sets')
+    except Exception as e:
+      print(e)
+      return (HTTPStatus(400), {}, bytes())
+
+    statuses = {}
+    sets = {}
+    for org_id, value in obj.items():
+      if org_id not in self.orgs:
+        statuses[org_id] = 404
+        continue
+      try:
+        emotes = parse_emotes(value)
+      except Exception:
+        statuses[org_id] = 400
+        continue
+      if len(emotes) == 0:
+        statuses[org_id] = 204
+      else:
+        sets[org_id] = emotes
+
+    # every org is saved in the same transaction
+    try:
+      saved = await db.save_emotes_bulk(sets)
+    except Exception:
+      saved = {}
+      statuses.update({org_id: 500 for org_id in sets})
+
+    for org_id, (emotes, added, removed) in saved.items():
+      statuses[org_id] = 200
+      if len(added) > 0 or len(removed) > 0:
+        await self.update_emotes(org_id, emotes, added, removed)
+    return bulk_response([{'org_id': org_id, 'status': statuses[org_id]} for org_id in obj])
+
+  # PUT /streams [{"org_id": str, "stream_id": str, "options"?: {...}}, ...]
+  async def handle_bulk_stream_setup(self, req: object, params: Dict[str, str]) -> HTTPResponse:
+    try:
+      items = json.loads(req['body'].decode('utf-8'))
+      if not isinstance(items, list):
+        raise Exception('invalid stream list')
+    except Exception as e:
+      print(e)
+      return (HTTPStatus(400), {}, bytes())
+
+    results = []
+    new_streams = {}
+    for item in items:
+      try:
+        org_id = item['org_id']
+        stream_id = item['stream_id']
+        if not all(isinstance(id, str) and ID_PATTERN.fullmatch(id) for id in [org_id, stream_id]):
+          raise Exception('invalid id')
+        options = check_stream_options(item.get('options', {}))
+      except Exception:
+        results += [{'org_id': item.get('org_id') if isinstance(item, dict) else None,
+                     'stream_id': item.get('stream_id') if isinstance(item, dict) else None,
+                     'status': 400}]
+        continue
+
+      results += [{'org_id': org_id, 'stream_id': stream_id}]
+      if stream_id in self.streams or stream_id in new_streams:
+        results[-1]['status'] = 304
+      else:
+        results[-1]['status'] = 201
+        new_streams[stream_id] = (org_id, options)
+
+    # orgs and then streams are created concurrently
+    await self.setup_orgs([org_id for org_id, _ in new_streams.values()])
+    await asyncio.gather(*[
+      self.setup_stream(org_id, stream_id, options) for stream_id, (org_id, options) in new_streams.items()
+    ])
+    for stream_id, (org_id, options) in new_streams.items():
+      self.send_stream_setup(self.orgs[org_id], stream_id, options)
+    return bulk_response(results)
+
+  # DELETE /streams ["<stream_id>", ...]
+  async def handle_bulk_stream_teardown(self, req: object, params: Dict[str, str]) -> HTTPResponse:
+    try:
+      stream_ids = parse_id_list(req['body'])
+    except Exception as e:
+      print(e)
+      return (HTTPStatus(400), {}, bytes())
+
+    results = []
+    for stream_id in stream_ids:
+      if stream_id not in self.streams:
+        results += [{'stream_id': stream_id, 'status': 404}]
+        continue
+      if not self.streams[stream_id].deleted:
+        self.teardown_stream(stream_id)
+        self.bus.send({'op': 'stream_teardown', 'stream_id': stream_id, 'retain': f'stream:{stream_id}'})
+      results += [{'stream_id': stream_id, 'status': 200}]
+    return bulk_response(results)
+
+  # PUT /stream/{stream_id}/filters [{"type": str, ...}, ...]
+  async def handle_update_filters(self, req: object, params: Dict[str, str]) -> HTTPResponse:
+    stream_id = params['stream_id']
+    if stream_id not in self.streams:
+      return (HTTPStatus(404), {}, bytes())
+
+    try:
+      filters = check_filters(json.loads(req['body'].decode('utf-8')))
+      pipeline = Pipeline.create(filters)
+    except Exception as e:
+      print(e)
+      return (HTTPStatus(400), {}, bytes())
+
+    self.streams[stream_id].pipeline = pipeline
+    self.bus.send({'op': 'filters', 'stream_id': stream_id, 'filters': filters, 'retain': f'filters:{stream_id}'})
+    return (HTTPStatus(200), {}, bytes())
+
+  # GET /stream/{stream_id}/stats
+  async def handle_stream_stats(self, req: object, params: Dict[str, str]) -> HTTPResponse:
+    stream_id = params['stream_id']
+    if stream_id not in self.streams:
+      return (HTTPStatus(404), {}, bytes())
+
+    stream = self.streams[stream_id]
+    body = json.dumps(stream.stats()).encode('utf-8')
+    return (HTTPStatus(200), {'Content-Type': 'application/json'}, body)
+
+  # GET /stream/{stream_id}/history?since=&until=&limit=
+  async def handle_stream_history(self, req: object, params: Dict[str, str]) -> HTTPResponse:
+    stream_id = params['stream_id']
+    try:
+      since, until, limit = parse_history_query(req['query'])
+    except Exception as e:
+      print(e)
+      return (HTTPStatus(400), {}, bytes())
+
+    reader = await self.open_log_reader(stream_id)
+    if reader is None:
+      return (HTTPStatus(404), {}, bytes())
+
+    # one extra record tells whether there are more
+    loop = asyncio.get_event_loop()
+    records = await loop.run_in_executor(None, reader.query, since, until, limit + 1)
+    body = json.dumps({
+      'messages': records[:limit],
+      'more': len(records) > limit
+    }).encode('utf-8')
+    return (HTTPStatus(200), {'Content-Type': 'application/json'}, body)
+
+  # GET /stream/{stream_id}/export?since=&until=
+  async def handle_stream_export(self, req: object, params: Dict[str, str]) -> HTTPResponse:
+    stream_id = params['stream_id']
+    try:
+      since, until = parse_time_range(req['query'])
+    except Exception as e:
+      print(e)
+      return (HTTPStatus(400), {}, bytes())
+
+    reader = await self.open_log_reader(stream_id)
+    if reader is None:
+      return (HTTPStatus(404), {}, bytes())
+
+    loop = asyncio.get_event_loop()
+    ranges = await loop.run_in_executor(None, reader.ranges, since, until)
+    gzip = 'gzip' in req['headers'].get('Accept-Encoding', '')
+    headers = {
+      'Content-Type': 'application/x-ndjson',
+      'Content-Disposition': f'attachment; filename="{stream_id}.ndjson"',
+    }
+    if gzip:
+      headers['Content-Encoding'] = 'gzip'
+    return (HTTPStatus(200), headers, export_body(ranges, gzip))
+
+  async def open_log_reader(self, stream_id: str) -> Optional[LogReader]:
+    """
+    Returns a reader for the log of a live or ended stream, with what
+    every worker has written so far. The last few readers are kept so
+    a query only reads the indexes of the segments it needs.
+    """
+    path = store_path(stream_id)
+    if not os.path.isdir(path):
+      self.log_readers.pop(stream_id, None)
+      return None
+
+    loop = asyncio.get_event_loop()
+    reader = self.log_readers.pop(stream_id, None)
+    if reader is None:
+      reader = await loop.run_in_executor(None, LogReader.open, path)
+    else:
+      await loop.run_in_executor(None, reader.refresh)
+    self.log_readers[stream_id] = reader
+    while len(self.log_readers) > self.LOG_READERS:
+      self.log_readers.popitem(last=False)
+    return reader
+
   # handle pre-websocket connections
   async def handle_pre_connection(self, ws: WebsocketProtocol) -> HTTPResponse:
     # print('pre connection')
@@ -204,6 +728,9 @@ class Server:
       if user:
         if user.name:
           stream.log_status(f'{user.name} left the chat')
+          # a user closed for flooding has to set up again
+          if not user.rate_limit_closed:
+            self.save_session(stream, user)
         stream.remove_user(user)
         stream.dis_event.set()
 
@@ -216,9 +743,35 @@ class Server:
       stream.add_user(user)
       stream.conn_event.set()
 
-      # send the viewer count and emotes
-      await user.send(message.viewers_message(len(stream.users)))
-      await user.send(message.emotes_message(stream.org.emotes))
+      # a reconnecting client skips the setup if its session is still
+      # around and it only missed messages that can be replayed
+      session = self.resume_session(ws, stream)
+      if session is not None:
+        user.name = session.name
+        user.email = session.email
+        user.batching = session.batching
+        user.send(message.viewers_message(stream.viewer_count()))
+        replay = stream.replay_message(int(ws.query['seq']))
+        if replay is not None:
+          user.send_prepared(replay)
+        # the emotes in the client's cache are preferred in case the
+        # last update didn't reach it before the connection dropped
+        version = ws.query.get('emotes_version', session.emotes_version)
+        update = stream.org.emotes_update(version)
+        if update is not None:
+          user.send_prepared(update)
+        user.send(message.session_message(user.token))
+        return user
+
+      # send the viewer count, the emotes unless the client has the
+      # current set cached and the recent messages
+      user.send(message.viewers_message(stream.viewer_count()))
+      update = stream.org.emotes_update(ws.query.get('emotes_version'))
+      if update is not None:
+        user.send_prepared(update)
+      history = stream.history_message()
+      if history is not None:
+        user.send_prepared(history)
 
       # after connecting the first message from the client should
       # be a 'setup' message containing information about the user
@@ -226,28 +779,72 @@ class Server:
       # received.
       while True:
         msg = await ws.recv()
-        setup = message.parse_message(msg)
+        try:
+          setup = message.parse_message(msg, ws.codec)
+        except message.InvalidMessageError:
+          continue
         if setup['type'] == 'setup':
           user.name = setup['name']
           user.email = setup['email']
+          user.batching = setup.get('batch') is True
           break
+
+      user.send(message.session_message(user.token))
       return user
-    except ConnectionClosed as e:
+    except BaseException as e:
+      # the user is only kept once it's set up
       stream.remove_user(user)
       stream.dis_event.set()
       raise e
 
+  def resume_session(self, ws: WebsocketProtocol, stream: Stream) -> Optional[Session]:
+    token = ws.query.get('resume')
+    seq = ws.query.get('seq', '')
+    if token is None or not seq.isdigit() or not stream.can_replay(int(seq)):
+      return None
+    session = stream.sessions.take(token)
+    if session is not None:
+      # tokens can only be used once, on any node
+      self.bus.send({'op': 'session_taken', 'stream_id': stream.id, 'token': token})
+    return session
+
+  # keeps the session of a disconnected user on every node
+  def save_session(self, stream: Stream, user: User):
+    session = user.session()
+    stream.sessions.save(user.token, session)
+    self.bus.send({
+      'op': 'session',
+      'stream_id': stream.id,
+      'token': user.token,
+      'session': session.to_dict()
+    })
+
   # tasks
 
   # updates the viewer count at a fixed rate
   async def update_viewer_count(self, stream: Stream):
     print(f'[stream {stream.id}] starting update_viewer_count task')
+    reported = 0
+    reported_at = 0.0
     while True:
         if len(stream.users) == 0:
+          if reported != 0:
+            reported = self.report_viewer_count(stream)
           await stream.conn_event.wait()
           stream.conn_event.clear()
         await asyncio.sleep(self.UPDATE_TIMEOUT)
-        await self.publish(stream, message.viewers_message(len(stream.users)))
+        # sent again now and then so other nodes know this one is still there
+        if len(stream.users) != reported or monotonic() - reported_at >= self.VIEWERS_REFRESH:
+          reported = self.report_viewer_count(stream)
+          reported_at = monotonic()
+        # every node sends the combined count to its own users
+        await self.publish_local(stream, message.viewers_message(stream.viewer_count()))
+
+  # sends the local viewer count to the other nodes
+  def report_viewer_count(self, stream: Stream) -> int:
+    count = len(stream.users)
+    self.bus.send({'op': 'viewers', 'stream_id': stream.id, 'count': count})
+    return count
   
   # closes "deleted" streams when all users disconnect
   async def close_deleted_stream(self, stream: Stream):
@@ -258,4 +855,6 @@ class Server:
       if len(stream.users) == 0 and stream.deleted:
         print('closing stream')
         stream.org.remove_stream(stream)
+        if self.streams.get(stream.id) is stream:
+          del self.streams[stream.id]
         await stream.close()
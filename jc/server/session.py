@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import secrets
+from collections import OrderedDict
+from time import monotonic
+
+from typing import Optional
+
+
+class Session:
+  """
+  What's needed to restore a user that reconnects
+  without going through setup again.
+  """
+  def __init__(self, name: str, email: str, batching: bool, emotes_version: str):
+    self.name = name
+    self.email = email
+    self.batching = batching
+    self.emotes_version = emotes_version
+    self.expires = 0.0
+
+  # sessions are sent to the other nodes so a client can
+  # resume on any of them
+  def to_dict(self) -> dict:
+    return {
+      'name': self.name,
+      'email': self.email,
+      'batching': self.batching,
+      'emotes_version': self.emotes_version,
+    }
+
+  @staticmethod
+  def from_dict(obj: dict) -> Session:
+    return Session(obj['name'], obj['email'], obj['batching'], obj['emotes_version'])
+
+  @staticmethod
+  def new_token() -> str:
+    return secrets.token_urlsafe(16)
+
+
+class SessionStore:
+  """
+  Sessions of disconnected users, kept until they expire or until
+  the store is full and they are the oldest.
+  """
+  def __init__(self, ttl: float, size: int):
+    self.ttl = ttl
+    self.size = size
+    self.sessions: OrderedDict = OrderedDict()
+
+  def save(self, token: str, session: Session):
+    now = monotonic()
+    session.expires = now + self.ttl
+    self.sessions[token] = session
+    self.sessions.move_to_end(token)
+    # sessions are ordered by when they expire
+    while len(self.sessions) > 0:
+      oldest = next(iter(self.sessions.values()))
+      if len(self.sessions) <= self.size and oldest.expires > now:
+        break
+      self.sessions.popitem(last=False)
+
+  def take(self, token: str) -> Optional[Session]:
+    session = self.sessions.pop(token, None)
+    if session is None or session.expires < monotonic():
+      return None
+    return session
@@ -1,12 +1,49 @@
 import asyncio
 from asyncio.tasks import Task
+from collections import OrderedDict, deque
+from time import monotonic
+from jc.server import message
+from jc.server.broadcast import Batcher, PreparedMessage
 from jc.server.logger import Logger
+from jc.server.message import MessageType
+from jc.server.outbox import OverflowPolicy
+from jc.server.pipeline import Pipeline
+from jc.server.ratelimit import PeerLimit, RateLimitPolicy, TokenBucket
+from jc.server.session import SessionStore
 from jc.server.user import User
 from jc.server.organization import Organization
 
-from typing import Callable, List, Set
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
 
 class Stream:
+  OUTBOX_SIZE = 256
+  OUTBOX_POLICY = OverflowPolicy.DROP_OLDEST
+  # recent text messages kept for replaying to resumed
+  # sessions, the last HISTORY_SIZE are sent to joining users
+  REPLAY_SIZE = 500
+  REPLAY_BYTES = 256 * 1024 # approximate, see PreparedMessage.size
+  HISTORY_SIZE = 50
+  # how long a disconnected session can be resumed
+  SESSION_TTL = 300
+  SESSIONS = 50000
+  # counts of other nodes that weren't sent again for
+  # this long are from nodes that went away
+  REMOTE_VIEWERS_TTL = 90
+  # chat messages per second and burst sizes allowed from a single
+  # user and from all users of the stream on this node. There are no
+  # limits unless a rate is set in the stream options.
+  USER_RATE = None
+  USER_BURST = 5
+  STREAM_RATE = None
+  STREAM_BURST = 400
+  RATE_LIMIT_POLICY = RateLimitPolicy.DROP
+  # peer addresses whose strikes are kept, least recently active go first
+  PEER_LIMITS = 50000
+  # rejected messages in a row before the policy escalates
+  RATE_LIMIT_STRIKES = 10
+  # slow mode divides the user's rate by this
+  SLOW_MODE_FACTOR = 4
+
   def __init__(self):
     self.id: str
     self.org: Organization
@@ -16,9 +53,32 @@ class Stream:
     self.users: Set[User]
     self.tasks: List[Task]
     self.deleted: bool
+    self.outbox_size: int
+    self.outbox_policy: str
+    self.dropped: int
+    self.batcher: Optional[Batcher]
+    # node -> (viewer count, when it was received)
+    self.remote_viewers: Dict[str, Tuple[int, float]]
+    self.seq: int
+    self.history: Deque[PreparedMessage]
+    self.history_bytes: int
+    self._history_message: Optional[PreparedMessage]
+    self._replay_messages: Dict[int, PreparedMessage]
+    self.sessions: SessionStore
+    self.pipeline: Pipeline
+    self.user_rate: Optional[float]
+    self.user_burst: int
+    self.peer_limits: OrderedDict
+    self.bucket: Optional[TokenBucket]
+    self.rate_limit_policy: str
+    self.rate_limited: Dict[str, int]
 
   @staticmethod
-  async def create(id: str, org: Organization):
+  async def create(id: str, org: Organization, outbox_size: int = OUTBOX_SIZE,
+                   outbox_policy: str = OUTBOX_POLICY, batch_interval: int = None,
+                   filters: List[Dict[str, Any]] = None, user_rate: Optional[float] = USER_RATE,
+                   user_burst: int = USER_BURST, stream_rate: Optional[float] = STREAM_RATE,
+                   stream_burst: int = STREAM_BURST, rate_limit_policy: str = RATE_LIMIT_POLICY):
     self = Stream()
     self.id = id
     self.org = org
@@ -28,9 +88,32 @@ class Stream:
     self.users = set()
     self.tasks = []
     self.deleted = False
+    self.outbox_size = outbox_size
+    self.outbox_policy = outbox_policy
+    self.dropped = 0
+    self.remote_viewers = {}
+    self.seq = 0
+    self.history = deque()
+    self.history_bytes = 0
+    self._history_message = None
+    self._replay_messages = {}
+    self.sessions = SessionStore(Stream.SESSION_TTL, Stream.SESSIONS)
+    self.pipeline = Pipeline.create(filters or [])
+    self.user_rate = user_rate
+    self.user_burst = user_burst
+    self.peer_limits = OrderedDict()
+    self.bucket = TokenBucket(stream_rate, stream_burst) if stream_rate is not None else None
+    self.rate_limit_policy = rate_limit_policy
+    self.rate_limited = {'user': 0, 'stream': 0, 'escalated': 0}
+    if batch_interval:
+      self.batcher = Batcher(batch_interval / 1000, self._send_batch)
+    else:
+      self.batcher = None
     return self
 
   async def close(self):
+    if self.batcher is not None:
+      self.batcher.close()
     for task in self.tasks:
       task.cancel()
     for task in self.tasks:
@@ -38,7 +121,8 @@ class Stream:
         await task
       except asyncio.CancelledError:
         pass
-    await asyncio.wait([user.conn.close() for user in self.users])
+    if len(self.users) > 0:
+      await asyncio.wait([user.conn.close() for user in self.users])
     await self.logger.close()
 
   def add_task(self, fn: Callable) -> Task:
@@ -51,6 +135,122 @@ class Stream:
 
   def remove_user(self, user: User):
     self.users.remove(user)
+    user.close()
+
+  # the escalation state of a peer address, or nothing if users aren't limited
+  def peer_limit(self, address: str) -> Optional[PeerLimit]:
+    if self.user_rate is None:
+      return None
+    limit = self.peer_limits.get(address)
+    if limit is None:
+      limit = PeerLimit()
+      self.peer_limits[address] = limit
+      if len(self.peer_limits) > self.PEER_LIMITS:
+        self.peer_limits.popitem(last=False)
+    else:
+      self.peer_limits.move_to_end(address)
+    return limit
+
+  # a bucket for a new connection, or nothing if users aren't limited
+  def user_bucket(self, limit: Optional[PeerLimit]) -> Optional[TokenBucket]:
+    if limit is None:
+      return None
+    if limit.slow_mode:
+      return TokenBucket(self.user_rate / self.SLOW_MODE_FACTOR, 1)
+    return TokenBucket(self.user_rate, self.user_burst)
+
+  # prepares a message for broadcasting, chat messages get the
+  # sequence number the sending node gave them, or the next
+  # one if this node is already past it
+  def prepare(self, obj: object, seq: int = None) -> PreparedMessage:
+    if obj['type'] == MessageType.TEXT:
+      self.seq = seq if seq is not None and seq > self.seq else self.seq + 1
+      obj = dict(obj, seq=self.seq)
+    return PreparedMessage(obj)
+
+  # sends a message to every user, text messages are
+  # held back by the batcher if batching is enabled
+  def broadcast(self, msg: PreparedMessage):
+    if msg.type == MessageType.TEXT:
+      self._add_history(msg)
+    if self.batcher is not None and msg.type == MessageType.TEXT:
+      self.batcher.add(msg)
+      return
+    for user in self.users:
+      user.send_prepared(msg)
+
+  def _send_batch(self, msgs: List[PreparedMessage], batch: PreparedMessage):
+    for user in self.users:
+      if user.batching:
+        user.send_prepared(batch)
+      else:
+        for msg in msgs:
+          user.send_prepared(msg)
+
+  def _add_history(self, msg: PreparedMessage):
+    self.history.append(msg)
+    self.history_bytes += msg.size()
+    while len(self.history) > self.REPLAY_SIZE or self.history_bytes > self.REPLAY_BYTES:
+      evicted = self.history.popleft()
+      self.history_bytes -= evicted.size()
+    self._history_message = None
+    self._replay_messages = {}
+
+  # the recent messages as a single message, built once per change
+  def history_message(self) -> Optional[PreparedMessage]:
+    if len(self.history) == 0:
+      return None
+    if self._history_message is None:
+      msgs = list(self.history)[-self.HISTORY_SIZE:]
+      self._history_message = self._list_message(msgs)
+    return self._history_message
+
+  def can_replay(self, seq: int) -> bool:
+    # only what's in the history can be replayed, which may start past
+    # 1 if messages were evicted or this node joined the stream late
+    if len(self.history) == 0:
+      return seq == self.seq
+    return self.history[0].obj['seq'] - 1 <= seq <= self.seq
+
+  def replay_message(self, seq: int) -> Optional[PreparedMessage]:
+    """
+    Returns the messages after `seq` as a single message, or nothing if
+    there are none. Clients that reconnect together usually missed the
+    same messages so the result is cached until the next message.
+    """
+    if seq == self.seq:
+      return None
+    if seq not in self._replay_messages:
+      msgs = [msg for msg in self.history if msg.obj['seq'] > seq]
+      self._replay_messages[seq] = self._list_message(msgs)
+    return self._replay_messages[seq]
+
+  def _list_message(self, msgs: List[PreparedMessage]) -> PreparedMessage:
+    return PreparedMessage(message.history_message([msg.obj for msg in msgs]), msgs)
+
+  def set_remote_viewers(self, node: str, count: int):
+    self.remote_viewers[node] = (count, monotonic())
+
+  # viewers connected to this and to other nodes
+  def viewer_count(self) -> int:
+    now = monotonic()
+    for node, (_, received) in list(self.remote_viewers.items()):
+      if now - received > self.REMOTE_VIEWERS_TTL:
+        del self.remote_viewers[node]
+    return len(self.users) + sum(count for count, _ in self.remote_viewers.values())
+
+  def count_dropped(self, count: int):
+    self.dropped += count
+
+  def stats(self) -> dict:
+    return {
+      'viewers': self.viewer_count(),
+      'dropped': self.dropped,
+      'batching': self.batcher is not None,
+      'logger': self.logger.metrics(),
+      'filters': self.pipeline.metrics(),
+      'rate_limited': self.rate_limited,
+    }
   
   def log_message(self, user: User, message: str): 
     assert user.stream == self
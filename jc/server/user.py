@@ -1,7 +1,10 @@
-import json
 from datetime import datetime
 from jc.server import message
+from jc.server.broadcast import PreparedMessage
 from jc.server.message import InvalidMessageError, MessageType
+from jc.server.outbox import Outbox
+from jc.server.ratelimit import RateLimitPolicy
+from jc.server.session import Session
 
 from typing import Any
 from websockets.legacy.protocol import WebSocketCommonProtocol
@@ -13,20 +16,83 @@ class User:
     self.email = email
     self.server = server
     self.conn = conn
+    self.batching = False
+    self.token = Session.new_token()
+    self.outbox = Outbox(conn, stream.outbox_size, stream.outbox_policy, stream.count_dropped)
+    # the bucket is per connection, the strikes and slow mode are per
+    # peer address as the client picks its name
+    address = conn.remote_address[0] if conn.remote_address else ''
+    self.rate_limit = stream.peer_limit(address)
+    self.bucket = stream.user_bucket(self.rate_limit)
+    self.rate_limit_closed = False
 
-  async def send(self, message: object):
-    msg = json.dumps(message)
-    await self.conn.send(msg)
+  def close(self):
+    self.outbox.close()
+
+  # what's needed to resume this user after it disconnects
+  def session(self) -> Session:
+    return Session(self.name, self.email, self.batching, self.stream.org.emotes_version)
+
+  def send(self, msg: object):
+    self.outbox.put(PreparedMessage(msg))
+
+  def send_prepared(self, msg: PreparedMessage):
+    self.outbox.put(msg)
+
+  # whether a chat message can be published now, checked
+  # before any work is done for it
+  def allow_message(self) -> bool:
+    stream = self.stream
+    limit = self.rate_limit
+    if self.bucket is not None:
+      if not self.bucket.take():
+        stream.rate_limited['user'] += 1
+        limit.strikes += 1
+        if limit.strikes >= stream.RATE_LIMIT_STRIKES or limit.disconnected:
+          self._escalate()
+        return False
+      limit.strikes = 0
+    # one user can't use up the stream's limit
+    if stream.bucket is not None and not stream.bucket.take():
+      stream.rate_limited['stream'] += 1
+      return False
+    return True
+
+  def _escalate(self):
+    limit = self.rate_limit
+    policy = self.stream.rate_limit_policy
+    if policy == RateLimitPolicy.SLOW_MODE and not limit.slow_mode:
+      limit.strikes = 0
+      limit.slow_mode = True
+      self.bucket = self.stream.user_bucket(limit)
+      self.stream.rate_limited['escalated'] += 1
+    elif policy == RateLimitPolicy.DISCONNECT:
+      # a peer that reconnects and goes on is closed
+      # again on the first rejected message
+      limit.disconnected = True
+      self.stream.rate_limited['escalated'] += 1
+      self.rate_limit_closed = True
 
   async def listen(self):
     async for msg in self.conn:
       try:
-        obj = message.parse_message(msg)
+        obj = message.parse_message(msg, self.conn.codec)
         if obj['type'] == MessageType.TEXT:
+          if not self.allow_message():
+            if self.rate_limit_closed:
+              await self.conn.close(1008, 'rate limited')
+              return
+            continue
+          text = await self.stream.pipeline.run(obj['text'])
+          if text is None:
+            continue
           today = datetime.utcnow()
           t_str = today.strftime('%Y-%m-%d %H:%M:%S')
-          self.stream.log_message(self, obj['text'])
-          await self.server.publish(self.stream, message.text_message(self.name, t_str, obj['text']))
+          await self.stream.logger.wait_writable()
+          self.stream.log_message(self, text)
+          # tokenized once here instead of by every client
+          segments = self.stream.org.emotes_matcher.tokenize(text)
+          msg = message.text_message(self.name, t_str, text, segments)
+          await self.server.publish(self.stream, msg)
       except InvalidMessageError:
         pass
-